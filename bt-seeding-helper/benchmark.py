@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Benchmark torrent verification and file matching on synthetic data.
+
+  $ ./benchmark.py --save baseline.json
+  $ ./benchmark.py --baseline baseline.json --tolerance 0.25
+
+Data sets are generated under a temporary directory (or --workdir) from
+a fixed seed, so runs are comparable across machines of the same kind.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+
+import metainfo
+import io_helper
+from torrent_file import TorrentFile
+from matcher import FileMatcher
+from verify_stats import VerifyStats
+
+MiB = 1 << 20
+
+# name: (file sizes, decoys per file, piece length)
+DATASETS = {
+    "small-files": (lambda scale: [7919 + 37 * i
+                                   for i in range(2000 * scale)],
+                    0, 1 << 16),
+    "huge-files": (lambda scale: [48 * MiB * scale + 12345, 32 * MiB * scale],
+                   0, 1 << 20),
+    "decoys": (lambda scale: [4 * MiB] * (6 * scale), 3, 1 << 18),
+}
+
+
+def make_dataset(workdir, name, sizes, decoys, piece_length, seed=0):
+    """Write the files and a v1 torrent; return (torrent, files, candidates).
+
+    candidates holds the real file plus `decoys` random files of the same
+    length for every torrent file.
+    """
+    rnd = random.Random(seed)
+    data_dir = os.path.join(workdir, name)
+    os.makedirs(data_dir, exist_ok=True)
+
+    files = []
+    pieces = []
+    tail = b""
+    for idx, size in enumerate(sizes):
+        path = os.path.join(data_dir, "%05d.bin" % idx)
+        files.append(path)
+        with open(path, "wb") as fout:
+            left = size
+            while left > 0:
+                chunk = rnd.randbytes(min(left, 4 * MiB))
+                fout.write(chunk)
+                left -= len(chunk)
+
+                tail += chunk
+                cut = len(tail) - len(tail) % piece_length
+                for i in range(0, cut, piece_length):
+                    piece = tail[i:i + piece_length]
+                    pieces.append(hashlib.sha1(piece).digest())
+                tail = tail[cut:]
+    if tail:
+        pieces.append(hashlib.sha1(tail).digest())
+
+    candidates = []
+    for idx, size in enumerate(sizes):
+        cands = {files[idx]}
+        for n in range(decoys):
+            path = os.path.join(data_dir, "%05d.decoy%d" % (idx, n))
+            with open(path, "wb") as fout:
+                fout.write(rnd.randbytes(size))
+            cands.add(path)
+        candidates.append(cands)
+
+    info = {
+        "name": name,
+        "piece length": piece_length,
+        "pieces": b"".join(pieces),
+        "files": [{"length": size, "path": [os.path.basename(path)]}
+                  for path, size in zip(files, sizes)],
+    }
+    torrent_path = os.path.join(workdir, name + ".torrent")
+    with open(torrent_path, "wb") as fout:
+        fout.write(metainfo.encode({"info": info}))
+
+    return TorrentFile(torrent_path), files, candidates
+
+
+def drop_caches(paths):
+    """Ask the kernel to forget cached pages, so reads hit the disk."""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_verify(torrent, files, workers, cold):
+    total = sum(length for _, length in torrent.get_files())
+    if cold:
+        drop_caches(files)
+    stats = VerifyStats()
+    start = time.perf_counter()
+    ok, _ = torrent.verify(files, workers=workers, stats=stats)
+    elapsed = time.perf_counter() - start
+    assert ok, "verification of generated data failed"
+    return {"mb_s": total / MiB / elapsed, "seconds": elapsed,
+            "seeks": stats.seeks, "io_s": stats.io_time,
+            "hash_s": stats.hash_time}
+
+
+def bench_read(files):
+    fds = [open(path, "rb") for path in files]
+    reader = io_helper.ReadHelper(fds)
+    buf = bytearray(1 << 20)
+    total = 0
+    start = time.perf_counter()
+    while True:
+        n = reader.readinto(buf)
+        if n == 0:
+            break
+        total += n
+    elapsed = time.perf_counter() - start
+    reader.close()
+    return {"mb_s": total / MiB / elapsed, "seconds": elapsed}
+
+
+def bench_match(torrent, candidates, workers):
+    stats = VerifyStats()
+    start = time.perf_counter()
+    matcher = FileMatcher(torrent, candidates, workers=workers,
+                          verbose=False, stats=stats)
+    order = matcher.match()
+    elapsed = time.perf_counter() - start
+    found = sum(path is not None for path in order)
+    return {"seconds": elapsed, "seeks": stats.seeks,
+            "mb_read": stats.bytes_read / MiB,
+            "found": found, "files": len(order)}
+
+
+def run(args, workdir):
+    results = {}
+    for name, (sizes, decoys, piece_length) in DATASETS.items():
+        if args.only and name not in args.only:
+            continue
+
+        print("Generating %s..." % name, file=sys.stderr)
+        torrent, files, candidates = make_dataset(
+            workdir, name, sizes(args.scale), decoys, piece_length)
+
+        results[name + "/read"] = bench_read(files)
+        results[name + "/verify"] = bench_verify(torrent, files, 1, args.cold)
+        results[name + "/verify-parallel"] = bench_verify(
+            torrent, files, args.workers, args.cold)
+        results[name + "/match"] = bench_match(torrent, candidates,
+                                               args.workers)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against baseline; return the list of regressions.
+
+    Throughput (mb_s) regresses when it drops, wall time (seconds) when it
+    grows, by more than tolerance.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric, higher_is_better in (("mb_s", True), ("seconds", False)):
+            new = results[key].get(metric)
+            old = baseline[key].get(metric)
+            if not new or not old:
+                continue
+            change = new / old - 1
+            print("%-28s %-8s %10.2f -> %10.2f  %+6.1f%%"
+                  % (key, metric, old, new, change * 100))
+            if (change < -tolerance if higher_is_better
+                    else change > tolerance):
+                regressions.append((key, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark torrent verification and file matching")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Multiply data set sizes by this factor.")
+    parser.add_argument("-j", "--workers", type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("--only", action="append",
+                        choices=sorted(DATASETS),
+                        help="Run only the given data set (repeatable).")
+    parser.add_argument("--cold", action="store_true",
+                        help="Drop the page cache before verifying.")
+    parser.add_argument("--workdir",
+                        help="Generate data here instead of a temp dir.")
+    parser.add_argument("--save", metavar="FILE",
+                        help="Write results as JSON.")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="Compare against saved results.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative regression (default 0.2).")
+    args = parser.parse_args()
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(args, workdir)
+
+    for key in sorted(results):
+        print("%-28s %s" % (key, " ".join(
+            "%s=%s" % (k, round(v, 3) if isinstance(v, float) else v)
+            for k, v in sorted(results[key].items()))))
+
+    if args.save:
+        with open(args.save, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressed: %s" % ", ".join(
+                "%s %s" % r for r in regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,51 +3,188 @@
 import os
 import re
 import sys
-import glob
 import time
-from urllib.parse import unquote
+import argparse
+import threading
+from html.parser import HTMLParser
+from urllib.parse import unquote, urljoin
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from bs4 import BeautifulSoup
-
-target_dir = sys.argv[1]
-if not os.path.isdir(target_dir):
-    os.mkdir(target_dir)
-os.chdir(target_dir)
-
-s = requests.Session()
-
-curl_str = input("Curl command: ")
-cookie_key = "c_secure_uid", "c_secure_pass", "c_secure_ssl", "c_secure_login"
-for key in cookie_key:
-    m = re.search(r"%s=([^;']+)" % key, curl_str)
-    val = m.group(1)
-    s.cookies.set(name=key, value=val)
-
-req = s.get("https://pt.sjtu.edu.cn/")
-m = re.search(r"userdetails\.php\?id=([0-9]+)", req.text)
-myid = m.group(1)
-
-for status in ("seeding", "completed", "incomplete"):
-    req = s.get("https://pt.sjtu.edu.cn/viewusertorrents.php",
-                params={"id": myid, "show": status})
-    print(status)
-    soup = BeautifulSoup(req.text, "html.parser")
-    for td in soup.find_all("td", class_="rowfollow"):
-        a_elem = td.find("a")
-        if a_elem is not None:
-            m = re.search(r"id=([0-9]+)", a_elem["href"])
-            tor_id = m.group(1)
-
-            if glob.glob(tor_id + " - *.torrent"):
-                continue
-
-            print("  " + tor_id)
-            req = s.get("https://pt.sjtu.edu.cn/download.php",
-                        params={ "id": tor_id })
-            cd = req.headers["content-disposition"]
-            m = re.search("filename=(.+)", cd)
-            fname = tor_id + " - " + unquote(m.group(1))
-            with open(fname, "wb") as f:
-                f.write(req.content)
-            time.sleep(1)
+
+MANIFEST = ".manifest"
+
+
+class TokenBucket:
+    """Allow `rate` requests per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class TorrentIdParser(HTMLParser):
+    """Collect torrent ids from the first link of each td.rowfollow."""
+
+    def __init__(self):
+        super().__init__()
+        self.ids = []
+        self._in_row = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "td":
+            self._in_row = "rowfollow" in (attrs.get("class") or "").split()
+        elif tag == "a" and self._in_row:
+            self._in_row = False
+            m = re.search(r"id=([0-9]+)", attrs.get("href") or "")
+            if m is not None:
+                self.ids.append(m.group(1))
+
+    def handle_endtag(self, tag):
+        if tag == "td":
+            self._in_row = False
+
+
+def iter_torrent_ids(session, bucket, url, params):
+    """Yield torrent ids while the page is still being downloaded."""
+    parser = TorrentIdParser()
+    bucket.acquire()
+    with session.get(url, params=params, stream=True) as req:
+        req.raise_for_status()
+        req.encoding = req.encoding or "utf8"
+        for chunk in req.iter_content(chunk_size=65536, decode_unicode=True):
+            parser.feed(chunk)
+            yield from parser.ids
+            parser.ids.clear()
+    parser.close()
+    yield from parser.ids
+
+
+class Manifest:
+    """Ids of downloaded torrents, appended to as downloads finish."""
+
+    def __init__(self, target_dir):
+        self.path = os.path.join(target_dir, MANIFEST)
+        self.lock = threading.Lock()
+        self.done = set()
+
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                self.done.update(line.strip() for line in fin)
+            self.done.discard("")
+
+        # Torrents downloaded before the manifest existed
+        for name in os.listdir(target_dir):
+            m = re.match(r"([0-9]+) - .*\.torrent", name)
+            if m is not None:
+                self.done.add(m.group(1))
+
+        self._fout = open(self.path, "a")
+
+    def add(self, tor_id):
+        with self.lock:
+            self.done.add(tor_id)
+            self._fout.write(tor_id + "\n")
+            self._fout.flush()
+
+    def close(self):
+        self._fout.close()
+
+
+def download(session, bucket, base_url, target_dir, manifest, tor_id):
+    bucket.acquire()
+    req = session.get(urljoin(base_url, "download.php"),
+                      params={"id": tor_id})
+    req.raise_for_status()
+    cd = req.headers["content-disposition"]
+    m = re.search("filename=(.+)", cd)
+    fname = tor_id + " - " + unquote(m.group(1))
+    fname = os.path.join(target_dir, fname.replace("/", "_"))
+
+    # Only complete files get their final name and a manifest entry, so
+    # an interrupted run simply downloads the torrent again.
+    tmp = os.path.join(target_dir, ".%s.part" % tor_id)
+    with open(tmp, "wb") as f:
+        f.write(req.content)
+    os.rename(tmp, fname)
+    manifest.add(tor_id)
+    print("  " + tor_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download all my torrents from PT.SJTU")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of concurrent downloads.")
+    parser.add_argument("-r", "--rate", type=float, default=1.0,
+                        help="Maximum requests per second.")
+    parser.add_argument("--base-url", default="https://pt.sjtu.edu.cn/")
+    parser.add_argument("target_dir")
+    args = parser.parse_args()
+
+    target_dir = os.path.realpath(args.target_dir)
+    if not os.path.isdir(target_dir):
+        os.mkdir(target_dir)
+    base_url = args.base_url.rstrip("/") + "/"
+
+    s = requests.Session()
+    bucket = TokenBucket(args.rate, burst=args.jobs)
+
+    curl_str = input("Curl command: ")
+    cookie_key = "c_secure_uid", "c_secure_pass", "c_secure_ssl", "c_secure_login"
+    for key in cookie_key:
+        m = re.search(r"%s=([^;']+)" % key, curl_str)
+        val = m.group(1)
+        s.cookies.set(name=key, value=val)
+
+    bucket.acquire()
+    req = s.get(base_url)
+    m = re.search(r"userdetails\.php\?id=([0-9]+)", req.text)
+    myid = m.group(1)
+
+    manifest = Manifest(target_dir)
+    scheduled = set(manifest.done)
+    failed = []
+
+    def fetch(tor_id):
+        try:
+            download(s, bucket, base_url, target_dir, manifest, tor_id)
+        except Exception as e:
+            print("  %s failed: %s" % (tor_id, e), file=sys.stderr)
+            failed.append(tor_id)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for status in ("seeding", "completed", "incomplete"):
+            print(status)
+            ids = iter_torrent_ids(s, bucket,
+                                   urljoin(base_url, "viewusertorrents.php"),
+                                   {"id": myid, "show": status})
+            for tor_id in ids:
+                if tor_id not in scheduled:
+                    scheduled.add(tor_id)
+                    executor.submit(fetch, tor_id)
+
+    manifest.close()
+    if failed:
+        print("%d downloads failed, run again to retry." % len(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
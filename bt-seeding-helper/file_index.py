@@ -0,0 +1,232 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def scan_dir(path, onerror=None):
+    """List a directory once with scandir.
+
+    Return (subdirs, files) where files are (path, target, stat) and
+    target is the resolved path of symlinks, None for other files.
+    Symlinks to directories are neither followed nor returned.
+
+    A directory that cannot be listed has no entries; as with os.walk,
+    the OSError is passed to onerror if given.
+    """
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+
+                target = None
+                if entry.is_symlink():
+                    target = os.path.realpath(entry.path)
+                files.append((entry.path, target, st))
+    except OSError as err:
+        if onerror is not None:
+            onerror(err)
+        return [], []
+    return subdirs, files
+
+
+def walk_tree(roots, probe, jobs=8):
+    """Run probe(dir) on every directory, many directories at a time.
+
+    probe returns (children, payload); children are walked next and
+    (dir, payload) is yielded in completion order.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(probe, root): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                children, payload = future.result()
+                for child in children:
+                    pending[executor.submit(probe, child)] = child
+                yield path, payload
+
+
+class FileIndex:
+    """Persistent (dev, ino, size, mtime, path) index of directory trees.
+
+    refresh() only lists directories whose mtime changed since the last
+    run; the files and subdirectories of the others are taken from the
+    index.  As creating, removing or renaming an entry always bumps the
+    mtime of its directory, this keeps the set of paths exact.  Sizes of
+    files rewritten in place are only picked up once their directory is
+    rescanned, which is fine for candidates that get hash-verified anyway.
+
+    Paths are stored as bytes so undecodable names survive the round trip.
+    """
+
+    # Stored as the mtime of directories that could not be listed, so
+    # that they never look unchanged
+    UNLISTED = -1
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path BLOB PRIMARY KEY,
+                parent BLOB,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+            CREATE TABLE IF NOT EXISTS files (
+                path BLOB PRIMARY KEY,
+                dir BLOB NOT NULL,
+                target BLOB,
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size);
+        """)
+        self._db.commit()
+
+    def refresh(self, *roots, jobs=8, prune=None):
+        """Bring the index up to date.
+
+        Directories are probed by `jobs` threads.  Subdirectories whose
+        name satisfies prune(name) are left out; use the same prune for
+        every refresh of an index.  What the index knows of a directory
+        that cannot be listed is kept, and it is tried again next time.
+
+        Return (rescanned, removed): the directories that were listed
+        again, and the (dev, ino) of files that left the index.
+        """
+        known = {}
+        children = {}
+        for path, parent, mtime_ns in self._db.execute(
+                "SELECT path, parent, mtime_ns FROM dirs"):
+            known[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+
+        def probe(path):
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                return [], (None, [], [])
+            if known.get(path) == mtime_ns:
+                return children.get(path, []), None
+
+            errors = []
+            subdirs, files = scan_dir(path, errors.append)
+            if errors:
+                return [], (self.UNLISTED, [], None)
+            if prune is not None:
+                subdirs = [d for d in subdirs
+                           if not prune(os.path.basename(d))]
+            return subdirs, (mtime_ns, subdirs, files)
+
+        rescanned = []
+        removed = set()
+        roots = [os.fsencode(os.path.realpath(root)) for root in roots]
+        for path, payload in walk_tree(roots, probe, jobs):
+            if payload is None:
+                continue
+
+            mtime_ns, subdirs, files = payload
+            if mtime_ns is None:
+                removed.update(self._forget_dir(path))
+                continue
+            if files is None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?,?,?)",
+                    (path, os.path.dirname(path), mtime_ns))
+                continue
+
+            rescanned.append(path)
+            for gone in set(children.get(path, ())).difference(subdirs):
+                removed.update(self._forget_dir(gone))
+            removed.update(self._update_dir(path, mtime_ns, files))
+
+        self._db.commit()
+        return rescanned, removed
+
+    def _update_dir(self, path, mtime_ns, files):
+        old = set(self._db.execute(
+            "SELECT dev, ino FROM files WHERE dir=?", (path,)))
+        rows = [(p, path, target, st.st_dev, st.st_ino, st.st_size,
+                 st.st_mtime_ns) for p, target, st in files]
+
+        self._db.execute("DELETE FROM files WHERE dir=?", (path,))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)", rows)
+        self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?,?,?)",
+                         (path, os.path.dirname(path), mtime_ns))
+        return old.difference((row[3], row[4]) for row in rows)
+
+    def _forget_dir(self, path):
+        removed = set()
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            stack.extend(r[0] for r in self._db.execute(
+                "SELECT path FROM dirs WHERE parent=?", (path,)))
+            removed.update(self._db.execute(
+                "SELECT dev, ino FROM files WHERE dir=?", (path,)))
+            self._db.execute("DELETE FROM files WHERE dir=?", (path,))
+            self._db.execute("DELETE FROM dirs WHERE path=?", (path,))
+        return removed
+
+    def knows(self, root):
+        """Whether root has been indexed by an earlier refresh"""
+        root = os.fsencode(os.path.realpath(root))
+        return self._db.execute("SELECT 1 FROM dirs WHERE path=?",
+                                (root,)).fetchone() is not None
+
+    def iter_files(self, *roots, dirs=None):
+        """Yield (path, target, dev, ino, size, mtime_ns) for every file
+        under the given roots, or only for those directly in `dirs`.
+        target is the resolved path of symlinks and None for other files."""
+        if dirs is not None:
+            queries = (("SELECT path, target, dev, ino, size, mtime_ns "
+                        "FROM files WHERE dir=?", (os.fsencode(d),))
+                       for d in dirs)
+        else:
+            queries = self._root_queries(roots)
+
+        for query, params in queries:
+            for path, target, *rest in self._db.execute(query, params):
+                if target is not None:
+                    target = os.fsdecode(target)
+                yield (os.fsdecode(path), target, *rest)
+
+    @staticmethod
+    def _root_queries(roots):
+        for root in roots:
+            root = os.fsencode(os.path.realpath(root))
+            # Everything in [b"root/", b"root0") is below root
+            prefix = os.path.join(root, b"")
+            yield ("""
+                SELECT path, target, dev, ino, size, mtime_ns FROM files
+                WHERE dir=? OR (dir>=? AND dir<?)""",
+                   (root, prefix, root + b"0"))
+
+    def iter_unique(self, *roots):
+        """Yield (real_path, size) once per inode, like dir_traveller."""
+        seen = set()
+        for path, target, dev, ino, size, _ in self.iter_files(*roots):
+            if (dev, ino) not in seen:
+                seen.add((dev, ino))
+                yield (target or path, size)
+
+    def by_size(self, size):
+        return [os.fsdecode(target or path) for path, target in
+                self._db.execute(
+                    "SELECT path, target FROM files WHERE size=?", (size,))]
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
@@ -0,0 +1,122 @@
+import os
+import time
+import sqlite3
+
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "bt-seeding-helper", "hash-cache.sqlite3")
+
+
+def file_identity(stat):
+    # Any write bumps st_mtime_ns, but that can be set back (touch -r,
+    # rsync -t); st_ctime_ns can't, and a replaced file gets a new inode.
+    # So a stale entry can only be looked up under a key that no longer
+    # exists.
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+            stat.st_ctime_ns)
+
+
+class HashCache:
+    """On-disk SHA-1 cache of file regions, keyed by file identity.
+
+    New hashes are kept in memory and written every `flush_rows` rows or
+    on close; the cache is trimmed to max_entries once enough rows were
+    written since the last count to possibly exceed it.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=None, max_entries=4 << 20, flush_rows=4096):
+        path = path or default_cache_path()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.max_entries = max_entries
+        self.flush_rows = flush_rows
+        self._touched = []
+        self._pending = {}
+        # Concurrent matchers each use their own connection
+        self._db = sqlite3.connect(path, timeout=60)
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if version != self.SCHEMA_VERSION:
+            # Entries keyed without st_ctime_ns can't be trusted
+            self._db.execute("DROP TABLE IF EXISTS piece_hash")
+            self._db.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS piece_hash (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                ctime_ns INTEGER, offset INTEGER, length INTEGER,
+                sha1 BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns,
+                             offset, length)
+            ) WITHOUT ROWID""")
+        self._db.execute("""
+            CREATE INDEX IF NOT EXISTS piece_hash_last_used
+            ON piece_hash (last_used)""")
+        self._db.commit()
+        self._room = self.max_entries - self._count()
+
+    def _count(self):
+        count, = self._db.execute("SELECT COUNT(*) FROM piece_hash").fetchone()
+        return count
+
+    def get(self, identity, offset, length):
+        key = identity + (offset, length)
+        if key in self._pending:
+            return self._pending[key]
+        row = self._db.execute("""
+            SELECT sha1 FROM piece_hash
+            WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?
+              AND offset=? AND length=?""", key).fetchone()
+        if row is None:
+            return None
+
+        # Recorded here and written in put_many, so lookups never hold
+        # the database write lock
+        self._touched.append(key)
+        return row[0]
+
+    def put_many(self, rows):
+        """Store (identity, offset, length, sha1) rows."""
+        for identity, offset, length, sha1 in rows:
+            self._pending[identity + (offset, length)] = sha1
+        if len(self._pending) + len(self._touched) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write pending rows and trim the cache."""
+        if not self._pending and not self._touched:
+            return
+
+        now = time.time()
+        self._db.executemany("""
+            UPDATE piece_hash SET last_used=?
+            WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?
+              AND offset=? AND length=?""",
+            ((now,) + key for key in self._touched))
+        self._touched = []
+        self._db.executemany(
+            "INSERT OR REPLACE INTO piece_hash VALUES (?,?,?,?,?,?,?,?,?)",
+            (key + (sha1, now) for key, sha1 in self._pending.items()))
+        # Replaced rows are counted too, so this only errs on the safe side
+        self._room -= len(self._pending)
+        self._pending = {}
+        if self._room < 0:
+            self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        excess = self._count() - self.max_entries
+        if excess > 0:
+            self._db.execute("""
+                DELETE FROM piece_hash WHERE (dev, ino, size, mtime_ns,
+                                              ctime_ns, offset, length) IN (
+                    SELECT dev, ino, size, mtime_ns, ctime_ns, offset, length
+                    FROM piece_hash ORDER BY last_used LIMIT ?)""", (excess,))
+        self._room = max(0, -excess)
+
+    def close(self):
+        self.flush()
+        self._db.close()
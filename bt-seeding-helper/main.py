@@ -2,14 +2,15 @@
 
 import os
 import sys
-import time
-import base64
 import bisect
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from bitarray import bitarray
-import transmissionrpc
-
-from torrent_file import TorrentFile
+from torrent_file import TorrentFile, iter_torrents
+from hash_cache import HashCache
+from matcher import FileMatcher
+from file_index import FileIndex
+from rpc_client import TransmissionRPC
 
 
 def dir_traveller(*dir_list):
@@ -25,29 +26,25 @@ def dir_traveller(*dir_list):
                     yield (fullpath, stat.st_size)
 
 
-def main():
-    torrent_path = sys.argv[1]
-    target_dir = os.path.realpath(sys.argv[2])
-    source_dirs = sys.argv[3:]
-
-    if not os.path.isdir(target_dir):
-        raise Exception("target_dir not found!")
-
-    torrent = TorrentFile(torrent_path)
-    with open(torrent_path, "rb") as fin:
-        torrent_data = base64.b64encode(fin.read()).decode("utf8")
+def build_pool(source_dirs, index_path=None):
+    if index_path is None:
+        files = dir_traveller(*source_dirs)
+    else:
+        index = FileIndex(index_path)
+        index.refresh(*source_dirs)
+        files = list(index.iter_unique(*source_dirs))
+        index.close()
+    return sorted((a, b) for b, a in files)
 
-    transmission = transmissionrpc.Client('localhost', port=9091)
-    for tor in transmission.get_torrents():
-        info_hash = tor._fields["hashString"].value
-        if info_hash == torrent.info_hash:
-            print("Already in download queue!")
-            sys.exit(0)
 
-    pool = sorted((a, b) for b, a in dir_traveller(*source_dirs))
+def find_candidates(pool, torrent):
     candidates = []
 
-    for bt_file, length in torrent.get_files():
+    for n_file, (bt_file, length) in enumerate(torrent.get_files()):
+        if torrent.is_padding(n_file):
+            candidates.append(set())
+            continue
+
         idx = bisect.bisect_right(pool, (length, ""))
         match_files = set()
 
@@ -57,36 +54,37 @@ def main():
 
         candidates.append(match_files)
 
-    def dfs_verify(depth, mask):
-        sys.stdout.write("\rDepth: %d/%d" % (depth, len(candidates)))
-        if depth == len(candidates):
-            return
-
-        for item in candidates[depth]:
-            order[depth] = item
-            success, result = torrent.verify(order, mask, True)
-            if success:
-                dfs_verify(depth + 1, mask & ~result)
-                break
-        else:
-            order[depth] = None
-            #dfs_verify(depth + 1, mask)
+    return candidates
+
 
-    order = [None] * len(candidates)
-    mask0 = bitarray(torrent.piece_num)
-    mask0.setall(True)
+def match_torrent(torrent, pool, workers, verbose=True):
+    candidates = find_candidates(pool, torrent)
+    cache = HashCache()
+    try:
+        matcher = FileMatcher(torrent, candidates, workers=workers,
+                              cache=cache, verbose=verbose)
+        return matcher.match()
+    finally:
+        cache.close()
 
-    print("DFS verify is running...")
-    sys.setrecursionlimit(max(sys.getrecursionlimit(), len(candidates) * 2))
-    dfs_verify(0, mask0)
 
-    print("\nResult:")
+def link_files(torrent, order, target_dir):
+    """Print the match result and link found files into target_dir.
+
+    Return (wanted, unwanted, data_dir), or None if nothing was found.
+    """
+    print("Result:")
     unwanted = []
     wanted = []
     have_a_piece = False
+    missing = False
     for idx, (_, length) in enumerate(torrent.get_files()):
         path = order[idx]
-        if path is None:
+        if torrent.is_padding(idx):
+            # Padding of hybrid torrents is zeros, nothing to link
+            unwanted.append(idx)
+        elif path is None:
+            missing = True
             print(" FILE%d not found" % idx)
             unwanted.append(idx)
         else:
@@ -94,12 +92,16 @@ def main():
             have_a_piece |= length > 2 * torrent.piece_length
             wanted.append(idx)
 
-    if not have_a_piece or any(item is None for item in order):
+    if not have_a_piece or missing:
         print("Nothing found!")
-        sys.exit(-1)
+        return None
 
     data_dir = os.path.join(target_dir, torrent.info_hash)
-    for real_path, (target_path, _) in zip(order, torrent.get_files()):
+    for idx, (target_path, _) in enumerate(torrent.get_files()):
+        real_path = order[idx]
+        if torrent.is_padding(idx):
+            continue
+
         dest = os.path.join(data_dir, *target_path)
         os.makedirs(os.path.dirname(dest), exist_ok=True)
 
@@ -111,30 +113,177 @@ def main():
         print("Link {} to {}".format(real_path, dest))
 
     os.chmod(data_dir, 0o555)
-    tor = transmission.add_torrent(torrent_data,
-                                   download_dir=data_dir,
-                                   files_wanted=wanted,
-                                   files_unwanted=unwanted)
-    tor_id = tor._fields['id'].value
-
-    tor = transmission.get_torrent(tor_id)
-    info_hash = tor._fields["hashString"].value
+    return wanted, unwanted, data_dir
+
+
+def add_to_transmission(rpc, torrent, torrent_path,
+                        data_dir, wanted, unwanted):
+    with open(torrent_path, "rb") as fin:
+        metainfo = fin.read()
+
+    tor_id, info_hash = rpc.add_torrent(metainfo,
+                                        download_dir=data_dir,
+                                        files_wanted=wanted,
+                                        files_unwanted=unwanted)
     if info_hash == torrent.info_hash:
         print("Torrent added to transmission queue!")
-        print("Wait for checking...")
-
-    while tor.status in ["checking", "check pending"]:
-        tor = transmission.get_torrent(tor_id)
-        time.sleep(1)
-
-    if tor.status != "seeding":
-        try:
-            raise Exception("Not seeding (status=%s)." % tor.status)
-        except Exception:
-            tor.stop()
-            raise
+    return tor_id
+
+
+def wait_for_checking(rpc, ids):
+    """Wait until the torrents are checked and stop those not seeding."""
+    print("Wait for checking...")
+    status = rpc.wait_checked(ids)
+    failed = [i for i, s in status.items() if s not in ("seeding", "removed")]
+    if failed:
+        rpc.stop(failed)
+    return status
+
+
+def list_torrents(path, from_list=False):
+    """Yield (path, TorrentFile) of the torrents to seed.
+
+    A listed torrent that can't be loaded is reported and yielded with
+    None, so the batch goes on without it.
+    """
+    if from_list:
+        with open(path) as fin:
+            for line in fin:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    torrent = TorrentFile(line)
+                except (OSError, ValueError, KeyError, IndexError,
+                        TypeError) as e:
+                    print("Skip %s: %r" % (line, e), file=sys.stderr)
+                    torrent = None
+                yield line, torrent
+    elif os.path.isdir(path):
+        yield from iter_torrents(path)
     else:
-        print("Torrent is in seeding status. I've done everything.")
+        yield path, TorrentFile(path)
+
+
+def seed_batch(torrents, target_dir, pool, rpc, jobs):
+    """Match torrents concurrently and add them one by one, then wait for
+    all of them to be checked at once.
+
+    Return a dict mapping each torrent path to its outcome.
+    """
+    queued = set(rpc.info_hashes())
+    added = {}
+    workers = max(1, (os.cpu_count() or 1) // jobs)
+    results = {}
+
+    torrents = iter(torrents)
+    futures = {}
+
+    def submit_next():
+        for path, torrent in torrents:
+            if torrent is None:
+                results[path] = "failed"
+                continue
+            if torrent.info_hash in queued:
+                print("%s: already in download queue!" % path)
+                results[path] = "queued"
+                continue
+            queued.add(torrent.info_hash)
+            future = executor.submit(match_torrent, torrent, pool,
+                                     workers, verbose=(jobs == 1))
+            futures[future] = path, torrent
+            return True
+        return False
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Keep only a couple of torrents per worker loaded at a time
+        while len(futures) < 2 * jobs and submit_next():
+            pass
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, torrent = futures.pop(future)
+                print("== %s" % path)
+                try:
+                    linked = link_files(torrent, future.result(), target_dir)
+                    if linked is None:
+                        results[path] = "not found"
+                    else:
+                        tor_id = add_to_transmission(rpc, torrent, path,
+                                                     *linked)
+                        added[tor_id] = path
+                except Exception as e:
+                    print("%s: %s" % (path, e))
+                    results[path] = "failed"
+                submit_next()
+
+    if added:
+        for tor_id, status in wait_for_checking(rpc, added).items():
+            results[added[tor_id]] = status
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Seed torrents from existing files")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of torrents matched concurrently.")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="TORRENT is a file listing one torrent per line.")
+    parser.add_argument("--index", metavar="PATH",
+                        help="Keep a persistent file index of the source "
+                             "dirs at PATH and only rescan changed dirs.")
+    parser.add_argument("--rpc-url",
+                        default="http://localhost:9091/transmission/rpc",
+                        help="Transmission RPC endpoint.")
+    parser.add_argument("torrent", metavar="TORRENT",
+                        help="A torrent file or a directory of torrents.")
+    parser.add_argument("target_dir", metavar="TARGET_DIR")
+    parser.add_argument("source_dirs", metavar="SOURCE_DIR", nargs="+")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    target_dir = os.path.realpath(args.target_dir)
+    if not os.path.isdir(target_dir):
+        raise Exception("target_dir not found!")
+
+    batch = args.list or os.path.isdir(args.torrent)
+    torrents = list_torrents(args.torrent, args.list)
+    rpc = TransmissionRPC(args.rpc_url)
+
+    if not batch:
+        torrent_path, torrent = next(torrents)
+        if rpc.has_torrent(torrent.info_hash):
+            print("Already in download queue!")
+            sys.exit(0)
+
+        pool = build_pool(args.source_dirs, args.index)
+        print("Matching files...")
+        order = match_torrent(torrent, pool, os.cpu_count())
+        linked = link_files(torrent, order, target_dir)
+        if linked is None:
+            sys.exit(-1)
+        tor_id = add_to_transmission(rpc, torrent, torrent_path, *linked)
+        status = wait_for_checking(rpc, [tor_id])[tor_id]
+        if status != "seeding":
+            raise Exception("Not seeding (status=%s)." % status)
+        else:
+            print("Torrent is in seeding status. I've done everything.")
+        return
+
+    pool = build_pool(args.source_dirs, args.index)
+    results = seed_batch(torrents, target_dir, pool, rpc, args.jobs)
+
+    print("Summary:")
+    for path in sorted(results):
+        print(" %-10s %s" % (results[path], path))
+
+    if any(r not in ("seeding", "queued") for r in results.values()):
+        sys.exit(-1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+import os
+import sys
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from verify_stats import VerifyStats
+
+
+class FileMatcher:
+    """Match every torrent file against its candidates independently.
+
+    Each candidate is first checked against the pieces lying entirely
+    inside its file.  The pieces shared by neighbouring files are then
+    settled one by one, see solve().
+
+    Every verification is counted in stats, a VerifyStats.
+    """
+
+    # Verifications allowed to settle one boundary piece.  Many small
+    # files inside a piece can only be checked all together, and every
+    # combination of their candidates may have to be tried.
+    MAX_TRIES = 1000
+
+    def __init__(self, torrent, candidates, workers=1, cache=None,
+                 verbose=True, stats=None):
+        self.torrent = torrent
+        self.candidates = [sorted(c) for c in candidates]
+        self.workers = workers
+        self.cache = cache
+        self.verbose = verbose
+        self.stats = VerifyStats() if stats is None else stats
+
+        self._ranges = []
+        self._names = []
+        offset = 0
+        for path, length in torrent.get_files():
+            self._ranges.append((offset, offset + length))
+            self._names.append(path[-1] if path else None)
+            offset += length
+
+        self._checked = {}
+
+    def _piece_span(self, idx):
+        begin, end = self._ranges[idx]
+        piece_length = self.torrent.piece_length
+        if begin == end:
+            return None
+        return begin // piece_length, (end - 1) // piece_length
+
+    def interior_pieces(self, idx):
+        begin, end = self._ranges[idx]
+        piece_length = self.torrent.piece_length
+        first = (begin + piece_length - 1) // piece_length
+        last = min(end // piece_length, self.torrent.piece_num)
+        if end == self._ranges[-1][1]:
+            # The short last piece still lies inside the last file
+            last = self.torrent.piece_num
+        return range(first, max(first, last))
+
+    def _boundary_pieces(self):
+        owners = {}
+        for idx in range(len(self._ranges)):
+            span = self._piece_span(idx)
+            if span is None:
+                continue
+            for piece in set(span):
+                owners.setdefault(piece, []).append(idx)
+
+        for piece in sorted(owners):
+            if len(owners[piece]) > 1:
+                yield piece, owners[piece]
+
+    def _verify(self, assignment, pieces):
+        # pieces is always a run, the interior of a file or one piece
+        return self.torrent.verify_range(assignment, pieces[0], pieces[-1],
+                                         workers=self.workers,
+                                         cache=self.cache,
+                                         stats=self.stats)
+
+    def _sample_pieces(self, idx, samples):
+        pieces = self.interior_pieces(idx)
+        if len(pieces) <= samples:
+            return list(pieces)
+        step = len(pieces) // samples
+        return [pieces[i * step + step // 2] for i in range(samples)]
+
+    def _fingerprint_ok(self, idx, path, pieces):
+        begin, _ = self._ranges[idx]
+        piece_length = self.torrent.piece_length
+        total = self._ranges[-1][1]
+        try:
+            with open(path, "rb") as fin:
+                for piece in pieces:
+                    offset = piece * piece_length
+                    size = min(piece_length, total - offset)
+                    data = os.pread(fin.fileno(), size, offset - begin)
+                    sha1 = hashlib.sha1(data).digest()
+                    if sha1 != self.torrent.get_piece_hash(piece):
+                        return False
+        except OSError:
+            return False
+        return True
+
+    def prefilter(self, samples=2):
+        """Cheaply drop candidates by hashing a few interior pieces.
+
+        Candidates are grouped by device and each device is read by its
+        own thread, so disks are busy in parallel without seek storms.
+        """
+        by_device = {}
+        for idx, cands in enumerate(self.candidates):
+            pieces = self._sample_pieces(idx, samples)
+            if not pieces:
+                continue
+            for path in cands:
+                try:
+                    dev = os.stat(path).st_dev
+                except OSError:
+                    dev = None
+                by_device.setdefault(dev, []).append((idx, path, pieces))
+
+        def check_device(tasks):
+            return [(idx, path) for idx, path, pieces in tasks
+                    if not self._fingerprint_ok(idx, path, pieces)]
+
+        rejected = set()
+        if by_device:
+            with ThreadPoolExecutor(max_workers=len(by_device)) as executor:
+                for failed in executor.map(check_device, by_device.values()):
+                    rejected.update(failed)
+
+        for idx, cands in enumerate(self.candidates):
+            self.candidates[idx] = [
+                path for path in cands if (idx, path) not in rejected]
+
+        return len(rejected)
+
+    def _report(self, stats=None):
+        # Pieces of a candidate rejected early are never read, so what is
+        # left is only known up to the candidate being verified.
+        idx, left, mark = self._interior
+        left -= self.stats.pieces_done - mark
+        sys.stdout.write("\rInterior: %d/%d, %s " % (
+            idx, len(self.candidates), self.stats.format(left)))
+        sys.stdout.flush()
+
+    def filter_candidates(self):
+        """Drop candidates failing any interior piece of their file."""
+        left = sum(len(self.interior_pieces(idx)) * len(cands)
+                   for idx, cands in enumerate(self.candidates))
+        self._interior = (0, left, self.stats.pieces_done)
+        if self.verbose:
+            progress, self.stats.progress = self.stats.progress, self._report
+
+        for idx, cands in enumerate(self.candidates):
+            pieces = self.interior_pieces(idx)
+            if not pieces:
+                continue
+
+            kept = []
+            for path in cands:
+                self._interior = (idx, left, self.stats.pieces_done)
+                if self._verify({idx: path}, pieces):
+                    kept.append(path)
+                left -= len(pieces)
+            self.candidates[idx] = kept
+
+        if self.verbose:
+            self.stats.progress = progress
+            self._interior = (len(self.candidates), 0, self.stats.pieces_done)
+            self._report()
+            sys.stdout.write("\n")
+
+    def _piece_ok(self, piece, assignment):
+        key = (piece, tuple(sorted(assignment.items())))
+        if key not in self._checked:
+            self._checked[key] = self._verify(assignment, (piece,))
+        return self._checked[key]
+
+    def _choices(self, idx):
+        """Candidates of a file, those named like it first"""
+        if self.torrent.is_padding(idx):
+            return [None]
+        name = self._names[idx]
+        return sorted(self.candidates[idx],
+                      key=lambda path: os.path.basename(path) != name)
+
+    def _settle(self, piece, files, choices):
+        """Find paths for files satisfying a boundary piece.
+
+        choices holds the paths to try for each file.  Return a dict
+        mapping a path of the last file to an assignment using it, for as
+        many of them as MAX_TRIES verifications find, and whether every
+        combination was tried.
+        """
+        found = {}
+        tries = 0
+        for last in choices[-1]:
+            for paths in itertools.product(*choices[:-1]):
+                if tries >= self.MAX_TRIES:
+                    return found, False
+                tries += 1
+                assignment = dict(zip(files, paths + (last,)))
+                if self._piece_ok(piece, assignment):
+                    found[last] = assignment
+                    break
+        return found, True
+
+    def solve(self):
+        """Return one path (or None) per torrent file.
+
+        Neighbouring boundary pieces share at most one file, the one
+        spanning from one to the other, so they form chains.  A forward
+        pass settles each piece for every path of that file left by the
+        piece before; a backward pass then picks one consistent
+        assignment.  A piece with a missing file, or too many candidate
+        combinations, is left unsettled and breaks the chain.  A piece
+        failing every combination rules out the paths of all its files.
+
+        A file gets a path only if a settled piece or its own interior
+        pieces vouch for it, and no boundary piece rules it out.
+        """
+        boundary = list(self._boundary_pieces())
+        settled = []
+        failed = set()
+        for n, (piece, files) in enumerate(boundary):
+            choices = [self._choices(idx) for idx in files]
+            linked = n > 0 and boundary[n - 1][1][-1] == files[0]
+            if linked and settled[-1]:
+                left = settled[-1]
+                choices[0] = [path for path in choices[0] if path in left]
+            found = {}
+            if all(choices):
+                found, complete = self._settle(piece, files, choices)
+                if not found and complete:
+                    failed.update(files)
+            settled.append(found)
+
+        order = [None] * len(self.candidates)
+        want = None
+        for n in reversed(range(len(boundary))):
+            _, files = boundary[n]
+            found = settled[n]
+            if not found:
+                want = None
+                continue
+            if want is None:
+                want = next(iter(found))
+            assignment = found[want]
+            for idx, path in assignment.items():
+                order[idx] = path
+
+            linked = n > 0 and boundary[n - 1][1][-1] == files[0]
+            want = assignment[files[0]] if linked else None
+
+        for idx, path in enumerate(order):
+            if idx in failed:
+                order[idx] = None
+                continue
+            if path is not None or self.torrent.is_padding(idx):
+                continue
+            begin, end = self._ranges[idx]
+            if begin == end or self.interior_pieces(idx):
+                # Nothing to check, or checked by filter_candidates
+                choices = self._choices(idx)
+                order[idx] = choices[0] if choices else None
+        return order
+
+    def match_v2(self):
+        """Match files of a v2 or hybrid torrent by their Merkle roots.
+
+        Each candidate is verified on its own, so all of them are checked
+        in parallel and no boundary pieces need to be settled.
+        """
+        order = [None] * len(self.candidates)
+        tasks = [(idx, path) for idx, cands in enumerate(self.candidates)
+                 if not self.torrent.is_padding(idx) for path in cands]
+
+        def check(task):
+            idx, path = task
+            try:
+                return self.torrent.verify_v2(idx, path)
+            except OSError:
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (idx, path), ok in zip(tasks, executor.map(check, tasks)):
+                if ok and order[idx] is None:
+                    order[idx] = path
+
+        return order
+
+    def match(self):
+        if self.torrent.is_v2:
+            return self.match_v2()
+
+        self.prefilter()
+        self.filter_candidates()
+        order = self.solve()
+        if self.verbose:
+            print(self.stats.summary(slowest=5))
+        return order
@@ -0,0 +1,110 @@
+"""
+Bencode helpers that work on byte offsets instead of decoded objects.
+
+Values are located by (start, end) spans into the raw buffer and only
+decoded on demand, so big strings like "pieces" are never copied.
+encode() is the plain recursive encoder, used to write test torrents.
+"""
+
+
+def skip(data, pos):
+    """Return the offset just past the value starting at pos."""
+    c = data[pos]
+    if c == 0x69:  # i
+        return data.index(b"e", pos) + 1
+    elif c == 0x6C or c == 0x64:  # l, d
+        pos += 1
+        while data[pos] != 0x65:  # e
+            pos = skip(data, pos)
+        return pos + 1
+    elif 0x30 <= c <= 0x39:
+        colon = data.index(b":", pos)
+        end = colon + 1 + int(data[pos:colon])
+        if end > len(data):
+            raise ValueError("Truncated string at %d" % pos)
+        return end
+    else:
+        raise ValueError("Invalid bencode at %d" % pos)
+
+
+def string_span(data, pos):
+    """Return the (start, end) of the payload of the string at pos."""
+    colon = data.index(b":", pos)
+    start = colon + 1
+    return start, start + int(data[pos:colon])
+
+
+def dict_spans(data, pos=0):
+    """Map each key of the dict at pos to the (start, end) of its value."""
+    if data[pos] != 0x64:
+        raise ValueError("Expect a dict at %d" % pos)
+
+    spans = {}
+    pos += 1
+    while data[pos] != 0x65:
+        key_start, key_end = string_span(data, pos)
+        end = skip(data, key_end)
+        spans[bytes(data[key_start:key_end])] = (key_end, end)
+        pos = end
+    return spans
+
+
+def decode(data, pos=0):
+    """Fully decode the value at pos; strings become bytes."""
+    value, _ = _decode(data, pos)
+    return value
+
+
+def _decode(data, pos):
+    c = data[pos]
+    if c == 0x69:
+        end = data.index(b"e", pos)
+        return int(data[pos + 1:end]), end + 1
+    elif c == 0x6C:
+        result = []
+        pos += 1
+        while data[pos] != 0x65:
+            item, pos = _decode(data, pos)
+            result.append(item)
+        return result, pos + 1
+    elif c == 0x64:
+        result = {}
+        pos += 1
+        while data[pos] != 0x65:
+            key, pos = _decode(data, pos)
+            result[key], pos = _decode(data, pos)
+        return result, pos + 1
+    else:
+        start, end = string_span(data, pos)
+        return bytes(data[start:end]), end
+
+
+def encode(value):
+    out = []
+    _encode(value, out)
+    return b"".join(out)
+
+
+def _encode(value, out):
+    if isinstance(value, int):
+        out.append(b"i%de" % value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(b"%d:" % len(value))
+        out.append(bytes(value))
+    elif isinstance(value, str):
+        _encode(value.encode(), out)
+    elif isinstance(value, list):
+        out.append(b"l")
+        for item in value:
+            _encode(item, out)
+        out.append(b"e")
+    elif isinstance(value, dict):
+        out.append(b"d")
+        items = {k.encode() if isinstance(k, str) else k: v
+                 for k, v in value.items()}
+        for k in sorted(items):
+            _encode(k, out)
+            _encode(items[k], out)
+        out.append(b"e")
+    else:
+        raise TypeError("Cannot bencode %r" % type(value))
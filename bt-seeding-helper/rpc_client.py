@@ -0,0 +1,123 @@
+import json
+import time
+import base64
+import urllib.error
+import urllib.request
+
+STATUS = {
+    0: "stopped",
+    1: "check pending",
+    2: "checking",
+    3: "download pending",
+    4: "downloading",
+    5: "seed pending",
+    6: "seeding",
+}
+
+
+class RPCError(Exception):
+    pass
+
+
+class TransmissionRPC:
+    """Minimal Transmission RPC client asking only for the fields we use."""
+
+    def __init__(self, url="http://localhost:9091/transmission/rpc",
+                 username=None, password=None, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self._session_id = None
+        self._hashes = None
+        self._headers = {"Content-Type": "application/json"}
+        if username is not None:
+            token = "%s:%s" % (username, password or "")
+            self._headers["Authorization"] = \
+                "Basic " + base64.b64encode(token.encode()).decode()
+
+    def call(self, method, **arguments):
+        body = json.dumps({"method": method, "arguments": arguments}).encode()
+
+        # The first request, and any after a daemon restart, is answered
+        # with 409 and the session id to retry with.
+        for _ in range(2):
+            headers = dict(self._headers)
+            if self._session_id is not None:
+                headers["X-Transmission-Session-Id"] = self._session_id
+            req = urllib.request.Request(self.url, data=body, headers=headers)
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    reply = json.load(resp)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code != 409:
+                    raise
+                self._session_id = e.headers["X-Transmission-Session-Id"]
+        else:
+            raise RPCError("Cannot obtain a session id")
+
+        if reply.get("result") != "success":
+            raise RPCError("%s: %s" % (method, reply.get("result")))
+        return reply.get("arguments", {})
+
+    def get_torrents(self, fields, ids=None):
+        arguments = {"fields": list(fields)}
+        if ids is not None:
+            arguments["ids"] = list(ids)
+        return self.call("torrent-get", **arguments)["torrents"]
+
+    def info_hashes(self, refresh=False):
+        """Info hashes of all torrents, fetched once and kept up to date
+        by add_torrent()."""
+        if self._hashes is None or refresh:
+            self._hashes = set(t["hashString"]
+                               for t in self.get_torrents(["hashString"]))
+        return self._hashes
+
+    def has_torrent(self, info_hash):
+        return info_hash in self.info_hashes()
+
+    def add_torrent(self, metainfo, **arguments):
+        """Add a torrent from raw metainfo bytes; return (id, hashString)."""
+        arguments["metainfo"] = base64.b64encode(metainfo).decode()
+        reply = self.call("torrent-add", **_dashed(arguments))
+        tor = reply.get("torrent-added") or reply["torrent-duplicate"]
+        self.info_hashes().add(tor["hashString"])
+        return tor["id"], tor["hashString"]
+
+    def stop(self, ids):
+        self.call("torrent-stop", ids=list(ids))
+
+    def statuses(self, ids):
+        return {t["id"]: STATUS.get(t["status"], t["status"])
+                for t in self.get_torrents(["id", "status"], ids)}
+
+    def wait_checked(self, ids, min_delay=0.5, max_delay=15, factor=1.5):
+        """Wait until none of ids is checking; return {id: status}.
+
+        All torrents are polled in one request, starting every min_delay
+        seconds and backing off to max_delay while nothing changes.
+        """
+        pending = set(ids)
+        result = {}
+        delay = min_delay
+        while pending:
+            status = self.statuses(pending)
+            # Torrents removed meanwhile are reported as gone
+            for tor_id in pending.difference(status):
+                status[tor_id] = "removed"
+
+            done = {i: s for i, s in status.items()
+                    if s not in ("checking", "check pending")}
+            result.update(done)
+            pending.difference_update(done)
+
+            if not pending:
+                break
+            delay = min_delay if done else min(delay * factor, max_delay)
+            time.sleep(delay)
+
+        return result
+
+
+def _dashed(arguments):
+    return {k.replace("_", "-"): v for k, v in arguments.items()}
@@ -1,59 +1,153 @@
 import os
+import sys
+import time
+import bisect
 import hashlib
 import datetime as dt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import bencoder
 from bitarray import bitarray
 
-from io_helper import ReadHelper, DummyReader
+import metainfo
+from io_helper import ReadHelper, DummyReader, ZeroReader
+from hash_cache import file_identity
 
 
-def _decode_dict_keys(d, encoding="utf8"):
-    if isinstance(d, dict):
-        new_dict = dict()
-        for k in d.keys():
-            if isinstance(k, bytes):
-                newk = k.decode(encoding)
-            new_dict[newk] = _decode_dict_keys(d[k], encoding)
-        return new_dict
-    elif isinstance(d, list):
-        return [_decode_dict_keys(item, encoding) for item in d]
-    else:
-        return d
+MERKLE_BLOCK = 16384
 
 
-def _bytes_helper(dict_, key, encoding="utf8"):
-    try:
-        raw = dict_[key]
-    except KeyError:
-        return None
-    else:
-        return raw.decode(encoding)
+def _block_hashes(data):
+    return [hashlib.sha256(data[i:i + MERKLE_BLOCK]).digest()
+            for i in range(0, len(data), MERKLE_BLOCK)]
+
+
+def _merkle_root(hashes, width, pad=bytes(32)):
+    """Root of a tree of `width` leaves, filled up with pad."""
+    layer = list(hashes) + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest()
+                 for i in range(0, len(layer), 2)]
+    return layer[0]
 
 
 class TorrentFile:
     def __init__(self, path):
         with open(path, "rb") as fin:
-            raw_dict = bencoder.decode(fin.read())
+            self._raw = fin.read()
+
+        self._meta = metainfo.dict_spans(self._raw)
+        info_start, info_end = self._meta[b"info"]
+        self._info = metainfo.dict_spans(self._raw, info_start)
+
+        # Hash the info dict as it is in the file, no re-encoding
+        raw_view = memoryview(self._raw)
+        info_raw = raw_view[info_start:info_end]
+        self._info_hash_v2 = None
+        if b"file tree" in self._info:
+            self._info_hash_v2 = hashlib.sha256(info_raw).hexdigest()
+
+        self._pieces = None
+        if b"pieces" in self._info:
+            pieces_start, _ = self._info[b"pieces"]
+            left, right = metainfo.string_span(self._raw, pieces_start)
+            self._pieces = raw_view[left:right]
+            self._info_hash = hashlib.sha1(info_raw).hexdigest()
+        elif self._info_hash_v2 is not None:
+            # v2-only torrents go by the truncated SHA-256 (BEP 52)
+            self._info_hash = self._info_hash_v2[:40]
+        else:
+            raise ValueError("Neither pieces nor file tree in info")
+
+        encoding = self._get(self._meta, b"encoding") or b"utf8"
+        self._encoding = encoding.decode() or "utf8"
+
+        self._piece_length = self._get(self._info, b"piece length")
+        self._file_list = None
+        self._file_starts = None
+        self._length_sum = None
+        self._padding = set()
+        self._v2_files = None
+        self._layer_spans = None
 
-        info_raw = bencoder.encode(raw_dict[b"info"])
-        self._encoding = raw_dict.get(b"encoding", b"utf8").decode()
-        self._encoding = self._encoding or "utf8"
-        self._info_hash = hashlib.sha1(info_raw).hexdigest()
+    def _get(self, spans, key):
+        try:
+            start, _ = spans[key]
+        except KeyError:
+            return None
+        else:
+            return metainfo.decode(self._raw, start)
 
-        self._dict = _decode_dict_keys(raw_dict, self._encoding)
+    def _get_str(self, spans, key):
+        raw = self._get(spans, key)
+        return None if raw is None else raw.decode(self._encoding)
 
-        self._files = []
-        if "files" in self._dict["info"]:
-            self._total_length = 0
-            for item in self._dict["info"]["files"]:
+    def _load_files(self):
+        files = []
+        raw_files = self._get(self._info, b"files")
+        if raw_files is not None:
+            for idx, item in enumerate(raw_files):
                 path = [self.name]
-                path.extend(i.decode(self._encoding) for i in item["path"])
-                self._files.append((tuple(path), item["length"]))
-                self._total_length += item["length"]
+                path.extend(i.decode(self._encoding) for i in item[b"path"])
+                files.append((tuple(path), item[b"length"]))
+                if b"p" in item.get(b"attr", b""):
+                    self._padding.add(idx)
+        elif b"length" in self._info:
+            files.append(((self.name,), self._get(self._info, b"length")))
         else:
-            self._total_length = self._dict["info"]["length"]
-            self._files.append(((self.name,), self._total_length))
+            files.extend((path, length) for path, (length, _)
+                         in self._load_v2_files().items())
+
+        self._file_list = files
+        self._file_starts = []
+        self._length_sum = 0
+        for _, length in files:
+            self._file_starts.append(self._length_sum)
+            self._length_sum += length
+
+    def _load_v2_files(self):
+        """Map path to (length, pieces root) from the BEP 52 file tree."""
+        if self._v2_files is not None:
+            return self._v2_files
+
+        files = {}
+        tree = self._get(self._info, b"file tree") or {}
+
+        def walk(node, prefix):
+            for name in sorted(node):
+                child = node[name]
+                path = prefix + (name.decode(self._encoding),)
+                if b"" in child:
+                    attrs = child[b""]
+                    files[path] = (attrs[b"length"],
+                                   attrs.get(b"pieces root"))
+                else:
+                    walk(child, path)
+
+        # A single file is named after the torrent, otherwise the torrent
+        # name is the top directory like in v1
+        single = len(tree) == 1 and b"" in next(iter(tree.values()))
+        walk(tree, () if single else (self.name,))
+        self._v2_files = files
+        return files
+
+    @property
+    def _files(self):
+        if self._file_list is None:
+            self._load_files()
+        return self._file_list
+
+    @property
+    def _starts(self):
+        if self._file_starts is None:
+            self._load_files()
+        return self._file_starts
+
+    @property
+    def _total_length(self):
+        if self._length_sum is None:
+            self._load_files()
+        return self._length_sum
 
     @property
     def info_hash(self):
@@ -61,25 +155,24 @@ class TorrentFile:
 
     @property
     def comment(self):
-        return _bytes_helper(self._dict, "comment", self._encoding)
+        return self._get_str(self._meta, b"comment")
 
     @property
     def created_by(self):
-        return _bytes_helper(self._dict, "created by", self._encoding)
+        return self._get_str(self._meta, b"created by")
 
     @property
     def name(self):
-        return _bytes_helper(self._dict["info"], "name", self._encoding)
+        return self._get_str(self._info, b"name")
 
     @property
     def source(self):
-        return _bytes_helper(self._dict["info"], "source", self._encoding)
+        return self._get_str(self._info, b"source")
 
     @property
     def creation_date(self):
-        try:
-            epoch = self._dict["creation date"]
-        except KeyError:
+        epoch = self._get(self._meta, b"creation date")
+        if epoch is None:
             return None
         else:
             obj = dt.datetime.fromtimestamp(epoch)
@@ -87,21 +180,21 @@ class TorrentFile:
 
     @property
     def announce(self):
-        if "announce-list" in self._dict:
+        if b"announce-list" in self._meta:
             result = []
-            for tier in self._dict["announce-list"]:
+            for tier in self._get(self._meta, b"announce-list"):
                 row = [r.decode(self._encoding) for r in tier]
                 result.append(row)
             return result
-        elif "announce" in self._dict:
-            url = self._dict["announce"].decode(self._encoding)
+        elif b"announce" in self._meta:
+            url = self._get_str(self._meta, b"announce")
             return [[url]]
         else:
             return None
 
     @property
     def piece_length(self):
-        return self._dict["info"]["piece length"]
+        return self._piece_length
 
     @property
     def piece_num(self):
@@ -109,72 +202,363 @@ class TorrentFile:
         down = self.piece_length
         return (up + down - 1) // down
 
+    @property
+    def pieces(self):
+        """The concatenated piece hashes, as a view into the raw file."""
+        return self._pieces
+
     @property
     def is_private(self):
-        return self._dict["info"]["private"] != 0
+        return (self._get(self._info, b"private") or 0) != 0
 
     def get_piece_hash(self, n_piece):
         left = n_piece * 20
         right = left + 20
-        sha1 = self._dict["info"]["pieces"][left:right]
+        sha1 = self._pieces[left:right].tobytes()
         return sha1
 
+    @property
+    def info_hash_v2(self):
+        return self._info_hash_v2
+
+    @property
+    def is_v2(self):
+        return self._info_hash_v2 is not None
+
     def get_files(self):
         yield from iter(self._files)
 
-    def verify(self, files, mask=None, exit_on_fail=False):
+    def is_padding(self, n_file):
+        if self._file_list is None:
+            self._load_files()
+        return n_file in self._padding
+
+    def _piece_layer(self, pieces_root):
+        """The piece layer of a file, None if the torrent lacks it"""
+        if self._layer_spans is None:
+            self._layer_spans = {}
+            if b"piece layers" in self._meta:
+                start, _ = self._meta[b"piece layers"]
+                self._layer_spans = metainfo.dict_spans(self._raw, start)
+
+        if pieces_root not in self._layer_spans:
+            return None
+        start, _ = self._layer_spans[pieces_root]
+        left, right = metainfo.string_span(self._raw, start)
+        return memoryview(self._raw)[left:right]
+
+    def verify_v2(self, n_file, path):
+        """Check path against the Merkle tree of torrent file n_file.
+
+        Only the candidate file itself is read, so files can be verified
+        independently and in any order.
+        """
+        file_path, length = self._files[n_file]
+        length, pieces_root = self._load_v2_files()[file_path]
+        if os.path.getsize(path) != length:
+            return False
+        if length == 0:
+            return True
+
+        piece_length = self.piece_length
+        piece_blocks = piece_length // MERKLE_BLOCK
+        buf = memoryview(bytearray(piece_length))
+
+        with open(path, "rb") as fin:
+            if length <= piece_length:
+                n = fin.readinto(buf)
+                leaves = _block_hashes(buf[:n])
+                width = 1 << (len(leaves) - 1).bit_length()
+                return _merkle_root(leaves, width) == pieces_root
+
+            layer = self._piece_layer(pieces_root)
+            if layer is None:
+                # Nothing to check the file against
+                return False
+            hashes = []
+            for offset in range(0, len(layer), 32):
+                n = fin.readinto(buf)
+                sha256 = _merkle_root(_block_hashes(buf[:n]), piece_blocks)
+                if sha256 != layer[offset:offset + 32]:
+                    return False
+                hashes.append(sha256)
+
+        # The layer itself must hash up to the root in the file tree
+        pad = _merkle_root([], piece_blocks)
+        width = 1 << (len(hashes) - 1).bit_length()
+        return _merkle_root(hashes, width, pad) == pieces_root
+
+    def verify(self, files, mask=None, exit_on_fail=False, workers=1,
+               cache=None, stats=None):
         if mask is None:
             mask = bitarray(self.piece_num)
             mask.setall(True)
         else:
             mask = bitarray(mask)
 
-        result = bitarray(self.piece_num)
-        result.setall(False)
-
         if len(mask) != self.piece_num:
             raise ValueError("len(mask) != piece_num")
 
         if len(files) != len(self._files):
             raise ValueError("len(files) not match")
 
+        fd_list, regions = self._open_files(enumerate(files), 0, mask, 0)
+        return self._check(fd_list, regions, mask, 0, exit_on_fail,
+                           workers, cache, stats)
+
+    def verify_range(self, files, first, last, workers=1, cache=None,
+                     stats=None):
+        """Check pieces first to last, opening only the files they span.
+
+        files maps the index of a file to its path, any file left out is
+        taken as missing.  As with verify(), pieces of missing files are
+        not checked.  The cost does not grow with the number of files in
+        the torrent, so checking many small ranges stays cheap.  Stop at
+        the first failed piece and return whether all matched.
+        """
+        piece_length = self.piece_length
+        begin = first * piece_length
+        end = min((last + 1) * piece_length, self._total_length)
+        starts = self._starts
+        lo = max(0, bisect.bisect_right(starts, begin) - 1)
+        hi = bisect.bisect_left(starts, end, lo)
+
+        mask = bitarray(last - first + 1)
+        mask.setall(True)
+        items = ((idx, files.get(idx)) for idx in range(lo, hi))
+        fd_list, regions = self._open_files(items, starts[lo], mask, first)
+        # Stands in for the files before the range, which are never read
+        fd_list.insert(0, DummyReader(starts[lo]))
+        success, _ = self._check(fd_list, regions, mask, first, True,
+                                 workers, cache, stats)
+        return success
+
+    def _open_files(self, items, offset, mask, first):
+        """Open (idx, path) of consecutive files starting at offset.
+
+        Pieces of missing or wrong-size files are cleared from mask, whose
+        bit 0 stands for piece first.  Return the readers and the regions
+        of the files opened.
+        """
         fd_list = []
-        acc_length = 0
+        regions = []
+        acc_length = offset
         piece_length = self.piece_length
-        for path, (_, length) in zip(files, self._files):
-            if path is None or os.path.getsize(path) != length:
+        for idx, path in items:
+            length = self._files[idx][1]
+            if self.is_padding(idx):
+                # Padding is zeros by definition, whatever path it got
+                fd_list.append(ZeroReader(length))
+                acc_length += length
+                continue
+            stat = None if path is None else os.stat(path)
+            if length == 0:
+                # Empty files cover no piece whether they exist or not
+                fd_list.append(DummyReader(length))
+            elif stat is None or stat.st_size != length:
                 first_piece = acc_length // piece_length
                 acc_length += length
                 last_piece = (acc_length - 1) // piece_length
-                mask[first_piece:last_piece+1] = False
+                mask[max(0, first_piece - first):last_piece - first + 1] = False
                 fd_list.append(DummyReader(length))
             else:
                 fd_list.append(open(path, "rb"))
+                regions.append((acc_length, path, file_identity(stat)))
                 acc_length += length
 
-        reader = ReadHelper(fd_list)
+        return fd_list, regions
+
+    def _check(self, fd_list, regions, mask, first, exit_on_fail, workers,
+               cache, stats):
+        result = bitarray(len(mask))
+        result.setall(False)
+
+        reader = ReadHelper(fd_list, stats=stats)
+        locate = self._piece_locator(regions) if cache is not None else None
+        # With a pool, a buffer must outlive the pieces still queued for
+        # hashing, see _hash_parallel.
+        buffers = 2 * workers + 2 if workers > 1 else 1
+        pieces = self._iter_pieces(reader, mask, locate, cache, buffers,
+                                   first)
+        if workers > 1:
+            hashes = self._hash_parallel(pieces, workers)
+        else:
+            hashes = self._hash_serial(pieces)
+
+        if stats is not None:
+            wanted = mask.count()
+            stats.begin(wanted, len(mask) - wanted)
+
         gather_result = True
-        idx = 0
-        while idx < self.piece_num:
-            if not mask[idx]:
-                try:
-                    idx += mask[idx:].index(1)
-                except ValueError:
-                    break
-                else:
-                    reader.seek(idx * piece_length)
+        new_hashes = []
+        try:
+            for idx, loc, sha1, size, seconds in hashes:
+                if stats is not None:
+                    stats.add_piece(size, seconds)
 
-            data = reader.read(piece_length)
-            sha1 = hashlib.sha1(data).digest()
+                match = (sha1 == self.get_piece_hash(idx))
+                gather_result &= match
+                result[idx - first] = match
 
-            match = (sha1 == self.get_piece_hash(idx))
-            gather_result &= match
-            result[idx] = match
+                if loc is not None:
+                    new_hashes.append(loc + (sha1,))
 
-            if exit_on_fail and not gather_result:
-                break
-            else:
-                idx += 1
+                if exit_on_fail and not gather_result:
+                    break
+        finally:
+            hashes.close()
+            reader.close()
+            if stats is not None:
+                stats.end()
+
+        if cache is not None:
+            self._store_hashes(cache, new_hashes)
 
-        reader.close()
         return gather_result, result
+
+    def _piece_locator(self, regions):
+        """Map a piece index to (path, identity, offset, length) if the
+        piece lies within a single file."""
+        starts = [start for start, _, _ in regions]
+        piece_length = self.piece_length
+
+        def locate(idx):
+            begin = idx * piece_length
+            end = min(begin + piece_length, self._total_length)
+            pos = bisect.bisect_right(starts, begin) - 1
+            if pos < 0:
+                return None
+
+            start, path, identity = regions[pos]
+            if end > start + identity[2]:
+                return None
+            return path, identity, begin - start, end - begin
+
+        return locate
+
+    @staticmethod
+    def _store_hashes(cache, new_hashes):
+        # A file modified while it was being read may have kept its old
+        # mtime in the key we looked up, so drop its hashes.
+        unchanged = {}
+        rows = []
+        for path, identity, offset, length, sha1 in new_hashes:
+            if path not in unchanged:
+                try:
+                    unchanged[path] = file_identity(os.stat(path)) == identity
+                except OSError:
+                    unchanged[path] = False
+            if unchanged[path]:
+                rows.append((identity, offset, length, sha1))
+
+        cache.put_many(rows)
+
+    def _iter_pieces(self, reader, mask, locate=None, cache=None,
+                     buffers=1, first=0):
+        # Yields (idx, location, data, sha1) for the pieces set in mask,
+        # whose bit 0 stands for piece first.  Pieces found in the cache
+        # come with sha1 set and are not read; freshly read pieces carry
+        # their location so the caller can store their hash afterwards.
+        # data is a view into one of `buffers` reused buffers and is only
+        # valid until that buffer comes round again.
+        piece_length = self.piece_length
+        ring = [memoryview(bytearray(piece_length)) for _ in range(buffers)]
+        turn = 0
+        need_seek = first > 0
+        idx = first
+        while idx < first + len(mask):
+            if not mask[idx - first]:
+                try:
+                    idx += mask[idx - first:].index(1)
+                except ValueError:
+                    break
+                else:
+                    need_seek = True
+
+            loc = locate(idx) if locate is not None else None
+            if loc is not None:
+                _, identity, offset, length = loc
+                sha1 = cache.get(identity, offset, length)
+                if sha1 is not None:
+                    yield idx, None, None, sha1
+                    need_seek = True
+                    idx += 1
+                    continue
+
+            if need_seek:
+                reader.seek(idx * piece_length)
+                need_seek = False
+
+            buf = ring[turn]
+            turn = (turn + 1) % buffers
+            n = reader.readinto(buf)
+            yield idx, loc, buf[:n], None
+            idx += 1
+
+    @staticmethod
+    def _sha1(data):
+        # Return (digest, size, seconds); hashlib releases the GIL, so the
+        # time is spent hashing even when run in a pool.
+        start = time.perf_counter()
+        digest = hashlib.sha1(data).digest()
+        return digest, len(data), time.perf_counter() - start
+
+    @staticmethod
+    def _hash_serial(pieces):
+        # Yields (idx, location, sha1, size, seconds), size being None for
+        # cached pieces, like _hash_parallel.
+        for idx, loc, data, digest in pieces:
+            if digest is None:
+                yield (idx, loc) + TorrentFile._sha1(data)
+            else:
+                yield idx, loc, digest, None, 0.0
+
+    @staticmethod
+    def _hash_parallel(pieces, workers):
+        # Reading stays sequential in this thread while hashlib (which
+        # releases the GIL) runs in the pool.  Results are yielded in piece
+        # order and at most 2 * workers pieces are held in memory.
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for idx, loc, data, digest in pieces:
+                    if digest is None:
+                        digest = executor.submit(TorrentFile._sha1, data)
+                    else:
+                        digest = (digest, None, 0.0)
+                    pending.append((idx, loc, digest))
+                    if len(pending) >= 2 * workers:
+                        yield TorrentFile._pop_result(pending)
+
+                while pending:
+                    yield TorrentFile._pop_result(pending)
+            finally:
+                for _, _, digest in pending:
+                    if not isinstance(digest, tuple):
+                        digest.cancel()
+
+    @staticmethod
+    def _pop_result(pending):
+        idx, loc, digest = pending.popleft()
+        if not isinstance(digest, tuple):
+            digest = digest.result()
+        return (idx, loc) + digest
+
+
+def iter_torrents(directory, suffix=".torrent"):
+    """Yield (path, TorrentFile) for every torrent file in directory.
+
+    Torrents are loaded one at a time, so memory use is bounded by what
+    the caller keeps.  Files that fail to parse are reported and skipped.
+    """
+    with os.scandir(directory) as it:
+        entries = sorted(e.path for e in it
+                         if e.name.endswith(suffix) and e.is_file())
+
+    for path in entries:
+        try:
+            torrent = TorrentFile(path)
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            print("Skip %s: %r" % (path, e), file=sys.stderr)
+        else:
+            yield path, torrent
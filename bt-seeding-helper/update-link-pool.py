@@ -1,49 +1,171 @@
 #!/usr/bin/env python3
 
-import sys
 import os
+import time
 import pathlib
+import argparse
+from collections import Counter
+
+from file_index import FileIndex, scan_dir, walk_tree
+
+
+def is_hidden(name):
+    return os.fsdecode(name).startswith(".")
+
+
+def walk_files(base_dir, jobs, counts):
+    """Yield (path, st_ino) of every file under base_dir, skipping hidden
+    directories, with directories listed by `jobs` threads.  Skipped
+    directories other than the pool are counted as EXCLUDE, those that
+    cannot be listed as ERROR."""
+    pool_dir = os.path.join(str(base_dir), ".pool")
+
+    def probe(path):
+        errors = []
+        subdirs, files = scan_dir(path, errors.append)
+        hidden = [d for d in subdirs if is_hidden(os.path.basename(d))]
+        subdirs = [d for d in subdirs if d not in hidden]
+        return subdirs, (hidden, files, errors)
+
+    for _, (hidden, files, errors) in walk_tree([str(base_dir)], probe, jobs):
+        for err in errors:
+            print("ERROR:", err)
+            counts["ERROR"] += 1
+        for path in hidden:
+            if path != pool_dir:
+                print("EXCLUDE:", path)
+                counts["EXCLUDE"] += 1
+        for path, _, st in files:
+            yield path, st.st_ino
+
+
+def walk_index(base_dir, index_path, jobs, incremental, stats):
+    """Like walk_files, but through a FileIndex.
+
+    When incremental, only files in directories changed since the last
+    run are yielded.  The second value returned by the index refresh,
+    inodes that left the tree, is stored in stats["gone"]; it is None if
+    base_dir was not indexed before, as nothing is known to have left.
+    """
+    index = FileIndex(index_path)
+    known = index.knows(base_dir)
+    rescanned, removed = index.refresh(base_dir, jobs=jobs, prune=is_hidden)
+    stats["dirs"] = len(rescanned)
+    stats["gone"] = set(ino for _, ino in removed) if known else None
+
+    if incremental:
+        rows = index.iter_files(dirs=rescanned)
+    else:
+        rows = index.iter_files(base_dir)
+    for path, _, _, ino, _, _ in rows:
+        yield path, ino
+    index.close()
+
+
+def load_pool(pool_dir, counts, check_only=None):
+    """Return the inodes already in the pool and drop orphaned links.
+
+    Links are named after the inode of their target, so when check_only
+    is given, only those inodes are lstat'ed for st_nlink and the rest
+    are taken from their names.
+    """
+    dedup_list = set()
+    with os.scandir(pool_dir) as it:
+        for entry in it:
+            if check_only is not None and entry.name.endswith(".ln"):
+                try:
+                    ino = int(entry.name[:-3], 16)
+                except ValueError:
+                    ino = None
+                if ino is not None and ino not in check_only:
+                    dedup_list.add(ino)
+                    continue
+
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_nlink <= 1:
+                print("DEL:", entry.path)
+                os.unlink(entry.path)
+                counts["DEL"] += 1
+            else:
+                dedup_list.add(stat.st_ino)
+    return dedup_list
 
 
 def main():
-    base_dir = pathlib.Path(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description="Hardlink every file under BASE_DIR into BASE_DIR/.pool")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="Number of directories scanned concurrently.")
+    parser.add_argument("--index", metavar="PATH",
+                        help="Keep a persistent file index at PATH and only "
+                             "rescan changed dirs.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="With --index, only link files from changed "
+                             "dirs and only check pool links of removed "
+                             "files.  All links are checked when the index "
+                             "is new.")
+    parser.add_argument("base_dir", metavar="BASE_DIR")
+    args = parser.parse_args()
+
+    if args.incremental and args.index is None:
+        parser.error("--incremental requires --index")
+
+    start = time.monotonic()
+    counts = Counter()
+    stats = {}
+
+    base_dir = pathlib.Path(args.base_dir)
+    if args.index is not None:
+        # The index stores resolved paths
+        base_dir = base_dir.resolve()
     pool_dir = base_dir.joinpath(".pool")
     pool_dir.mkdir(0o755, exist_ok=True)
 
-    dedup_list = set()
-    for f in pool_dir.iterdir():
-        if not f.is_file() or f.is_symlink():
-            continue
-
-        stat = f.lstat()
-        if stat.st_nlink <= 1:
-            print("DEL:", f)
-            f.unlink()
-        else:
-            dedup_list.add(stat.st_ino)
+    if args.index is None:
+        files = walk_files(base_dir, args.jobs, counts)
+    else:
+        files = walk_index(base_dir, args.index, args.jobs,
+                           args.incremental, stats)
+
+    if args.incremental:
+        # The refresh has to run first to know which inodes are gone;
+        # with a new index that is unknown and every link is checked
+        files = list(files)
+        dedup_list = load_pool(pool_dir, counts, stats["gone"])
+    else:
+        dedup_list = load_pool(pool_dir, counts)
+
+    for path, ino in files:
+        rel = os.path.relpath(path, start=base_dir)
 
-    for dirpath, dirnames, filenames in os.walk(base_dir):
-        for item in filenames:
-            path = os.path.join(dirpath, item)
-            rel = os.path.relpath(path, start=base_dir)
+        for c in rel.split(os.path.sep):
+            if c.startswith("."):
+                print("EXCLUDE:", path)
+                counts["EXCLUDE"] += 1
+                break
+        else:
+            if ino in dedup_list:
+                print("SKIP:", path)
+                counts["SKIP"] += 1
+                continue
 
-            for c in rel.split(os.path.sep):
-                if c.startswith("."):
-                    print("EXCLUDE:", path)
-                    break
+            try:
+                os.link(path, pool_dir.joinpath("%x.ln" % ino))
+            except PermissionError:
+                counts["ERROR"] += 1
             else:
-                ino = os.stat(path).st_ino
-                if ino in dedup_list:
-                    print("SKIP:", path)
-                    continue
+                dedup_list.add(ino)
+                print("ADD:", path)
+                counts["ADD"] += 1
 
-                try:
-                    os.link(path, pool_dir.joinpath("%x.ln" % ino))
-                except PermissionError:
-                    pass
-                else:
-                    dedup_list.add(ino)
-                    print("ADD:", path)
+    summary = ", ".join("%s %d" % (k, counts[k])
+                        for k in ("ADD", "SKIP", "EXCLUDE", "DEL", "ERROR"))
+    if "dirs" in stats:
+        summary += ", %d dirs rescanned" % stats["dirs"]
+    print("Done in %.1fs: %s" % (time.monotonic() - start, summary))
 
 
 if __name__ == "__main__":
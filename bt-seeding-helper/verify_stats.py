@@ -0,0 +1,121 @@
+import time
+import datetime as dt
+
+MiB = 1 << 20
+
+
+class VerifyStats:
+    """Counters of the work done by TorrentFile.verify.
+
+    One object can be passed to any number of verify calls and adds up
+    over all of them.  io_time is spent waiting for reads in the reading
+    thread, hash_time is summed over the hashing threads and so may
+    exceed the wall time with a pool: a run is disk-bound when io_time is
+    close to the wall time and CPU-bound when hash_time / workers is.
+
+    pieces_skipped counts pieces left out by the mask of each call,
+    including those of missing files.  files maps every path read to
+    [bytes, seconds].
+
+    If given, progress(stats) is called at most every `interval` seconds
+    while pieces are being checked.
+    """
+
+    def __init__(self, progress=None, interval=1.0):
+        self.progress = progress
+        self.interval = interval
+
+        self.pieces_wanted = 0
+        self.pieces_done = 0
+        self.pieces_cached = 0
+        self.pieces_skipped = 0
+        self.bytes_read = 0
+        self.bytes_hashed = 0
+        self.seeks = 0
+        self.io_time = 0.0
+        self.hash_time = 0.0
+        self.wall_time = 0.0
+        self.files = {}
+
+        self._started = None
+        self._reported = 0.0
+
+    def begin(self, wanted, skipped):
+        self.pieces_wanted += wanted
+        self.pieces_skipped += skipped
+        self._started = time.perf_counter()
+
+    def end(self):
+        self.wall_time += time.perf_counter() - self._started
+        self._started = None
+
+    @property
+    def elapsed(self):
+        if self._started is None:
+            return self.wall_time
+        return self.wall_time + time.perf_counter() - self._started
+
+    def add_read(self, path, size, seconds):
+        self.bytes_read += size
+        self.io_time += seconds
+        if path is not None:
+            entry = self.files.setdefault(path, [0, 0.0])
+            entry[0] += size
+            entry[1] += seconds
+
+    def add_piece(self, size, seconds):
+        """Count a checked piece; size is None if its hash was cached."""
+        self.pieces_done += 1
+        if size is None:
+            self.pieces_cached += 1
+        else:
+            self.bytes_hashed += size
+            self.hash_time += seconds
+
+        if self.progress is not None:
+            now = time.monotonic()
+            if now - self._reported >= self.interval:
+                self._reported = now
+                self.progress(self)
+
+    def eta(self, remaining=None):
+        """Seconds needed for `remaining` more pieces (by default the rest
+        of those asked for so far) at the rate seen so far."""
+        if remaining is None:
+            remaining = self.pieces_wanted - self.pieces_done
+        elapsed = self.elapsed
+        if not self.pieces_done or not elapsed:
+            return None
+        return max(0, remaining) * elapsed / self.pieces_done
+
+    def file_throughput(self):
+        """Return (MB/s, path) of every file read, slowest first."""
+        return sorted((size / MiB / seconds if seconds else float("inf"),
+                       path) for path, (size, seconds) in self.files.items())
+
+    def format(self, remaining=None):
+        """One progress line: rate, where the time goes and the ETA."""
+        if remaining is None:
+            remaining = self.pieces_wanted - self.pieces_done
+        elapsed = self.elapsed or float("inf")
+        eta = self.eta(remaining)
+        return ("%d pieces checked, %d left, %.1f MB at %.1f MB/s "
+                "(I/O %.1fs, hash %.1fs), ETA %s" % (
+                    self.pieces_done, max(0, remaining),
+                    self.bytes_read / MiB, self.bytes_read / MiB / elapsed,
+                    self.io_time, self.hash_time,
+                    "?" if eta is None else dt.timedelta(seconds=int(eta))))
+
+    def summary(self, slowest=0):
+        lines = [
+            "Verified %d pieces (%d cached, %d skipped) in %.1fs"
+            % (self.pieces_done, self.pieces_cached, self.pieces_skipped,
+               self.wall_time),
+            "Read %.1f MB with %d seeks, hashed %.1f MB"
+            % (self.bytes_read / MiB, self.seeks, self.bytes_hashed / MiB),
+            "I/O %.1fs, hash %.1fs" % (self.io_time, self.hash_time),
+        ]
+        for rate, path in self.file_throughput()[:slowest]:
+            lines.append("  %8.1f MB/s %s" % (rate, path))
+        return "\n".join(lines)
+
@@ -1,60 +1,332 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import csv
 import json
+import mmap
+import time
+import shutil
+import threading
 import subprocess
 import tempfile
 import argparse
-
-parser = argparse.ArgumentParser(description="Simulate CrystalDiskMark using fio")
-parser.add_argument("-n", "--loops", type=int, default=5,
-                    help="Number of runs for each test.")
-parser.add_argument("-s", "--size", type=int, default=1024,
-                    help="IO size (in MiB) for each test.")
-parser.add_argument("target", help="Test directory.")
-args = parser.parse_args()
-
-cmd = ["fio",
-       "--loops=%d" % args.loops,
-       "--direct=1",
-       "--group_reporting",
-       "--output-format=json",
-       "--ioengine=libaio"]
+from random import shuffle
+from concurrent.futures import ThreadPoolExecutor
 
 all_tests = (("SEQ", 8, 1), ("SEQ", 1, 1), ("RND", 32, 16), ("RND", 1, 1))
 
-for test_type, iodepth, numjobs in all_tests:
-    name = "Q%dT%d" % (iodepth, numjobs)
+# Completion latency percentiles as fio names them
+PERCENTILES = (("p50_us", "50.000000"), ("p99_us", "99.000000"),
+               ("p99.9_us", "99.900000"))
+FIELDS = ("test", "rw", "mb_s", "iops") + tuple(k for k, _ in PERCENTILES)
+
+
+def test_matrix():
+    """Yield (name, random, bs in KiB, iodepth, numjobs, rw) in run order"""
+    for test_type, iodepth, numjobs in all_tests:
+        name = "Q%dT%d" % (iodepth, numjobs)
+
+        if test_type == "SEQ":
+            name = "SEQ1M " + name
+            random = False
+            bs = 1024
+        else:
+            name = "RND4K " + name
+            random = True
+            bs = 4
+
+        for rw in "read", "write":
+            yield name, random, bs, iodepth, numjobs, rw
+
+
+def section_name(name, rw):
+    return ("%s %s" % (name, rw)).replace(" ", "-")
+
+
+def make_job_file(filename, size, loops):
+    """The whole suite as one fio job file.
+
+    The test file is laid out and filled once by the first section; every
+    test then waits for the previous one with stonewall, which also
+    makes it a reporting group of its own.  Jobs of a multi-threaded test
+    work on separate slices of the file.
+    """
+    lines = [
+        "[global]",
+        "filename=%s" % filename,
+        "direct=1",
+        "ioengine=libaio",
+        "group_reporting",
+        "",
+        "[precondition]",
+        "rw=write",
+        "bs=1M",
+        "iodepth=8",
+        "size=%dM" % size,
+        "loops=1",
+    ]
+
+    for name, random, bs, iodepth, numjobs, rw in test_matrix():
+        slice_size = (size << 20) // numjobs
+        lines += [
+            "",
+            "[%s]" % section_name(name, rw),
+            "stonewall",
+            "rw=%s" % (("rand" if random else "") + rw),
+            "bs=%dk" % bs,
+            "iodepth=%d" % iodepth,
+            "numjobs=%d" % numjobs,
+            "size=%d" % slice_size,
+            "offset_increment=%d" % slice_size,
+            "loops=%d" % loops,
+        ]
+
+    return "\n".join(lines) + "\n"
+
+
+def run_fio(target, size, loops):
+    """Run the suite and return {(name, rw): fio job result}"""
+    with tempfile.NamedTemporaryFile(dir=target) as fp, \
+            tempfile.NamedTemporaryFile("w", suffix=".fio") as job_file:
+        job_file.write(make_job_file(fp.name, size, loops))
+        job_file.flush()
+        output = subprocess.check_output(
+            ["fio", "--output-format=json", job_file.name])
+
+    result = json.loads(output.decode())
+    jobs = {job["jobname"]: job for job in result["jobs"]}
+    return {(name, rw): jobs[section_name(name, rw)]
+            for name, _, _, _, _, rw in test_matrix()}
+
+
+def open_direct(path):
+    try:
+        return os.open(path, os.O_RDWR | os.O_DIRECT)
+    except OSError:
+        # tmpfs and some FUSE file systems refuse O_DIRECT
+        print("O_DIRECT not supported, results include the page cache",
+              file=sys.stderr)
+        return os.open(path, os.O_RDWR)
+
+
+def job_offsets(start, length, bs, random, loops):
+    blocks = list(range(start, start + length, bs))
+    for _ in range(loops):
+        if random:
+            # Like fio's random map: every block once per loop
+            shuffle(blocks)
+        yield from blocks
+
+
+def native_worker(fd, offsets, lock, bs, write):
+    """Do one request at a time until offsets run out; return latencies."""
+    # mmap memory is page aligned as O_DIRECT wants
+    buf = mmap.mmap(-1, bs)
+    if write:
+        buf.write(os.urandom(bs))
+    clat = []
+    while True:
+        with lock:
+            offset = next(offsets, None)
+        if offset is None:
+            break
+        start = time.perf_counter_ns()
+        if write:
+            os.pwrite(fd, buf, offset)
+        else:
+            os.preadv(fd, [buf], offset)
+        clat.append(time.perf_counter_ns() - start)
+    buf.close()
+    return clat
+
+
+def native_test(fd, random, bs, iodepth, numjobs, rw, size, loops):
+    """One test of the matrix; return a fio-like read or write result.
+
+    Each job works on its own slice of the file with iodepth threads
+    sharing its offsets, so iodepth requests are in flight per job.
+    """
+    slice_size = size // numjobs
+    jobs = [(job_offsets(n * slice_size, slice_size, bs, random, loops),
+             threading.Lock()) for n in range(numjobs)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=iodepth * numjobs) as executor:
+        futures = [executor.submit(native_worker, fd, offsets, lock, bs,
+                                   rw == "write")
+                   for offsets, lock in jobs for _ in range(iodepth)]
+        clat = sorted(lat for f in futures for lat in f.result())
+    elapsed = time.perf_counter() - start
+
+    ios = len(clat)
+    percentile = {fio_key: clat[min(ios - 1, int(ios * float(fio_key) / 100))]
+                  for _, fio_key in PERCENTILES} if ios else {}
+    return {"io_bytes": ios * bs, "bw_bytes": ios * bs / elapsed,
+            "iops": ios / elapsed, "clat_ns": {"percentile": percentile}}
 
-    if test_type == "SEQ":
-        name = "SEQ1M " + name
-        prefix = ""
-        bs = 1024
-    else:
-        name = "RND4K " + name
-        prefix = "rand"
-        bs = 4
-
-    for rw in "read", "write":
-        with tempfile.NamedTemporaryFile(dir=args.target) as fp:
-            newcmd = cmd + [
-                "--filename=" + fp.name,
-                "--size=%d" % ((args.size << 20) // numjobs),
-                "--name=" + name,
-                "--bs=%dk" % bs,
-                "--iodepth=%d" % iodepth,
-                "--numjobs=%d" % numjobs,
-                "--rw=%s" % (prefix + rw)]
-            output = subprocess.check_output(newcmd)
-        result = json.loads(output.decode())
-        perf = result["jobs"][0][rw]
 
+def run_native(target, size, loops):
+    """Run the suite in Python, for hosts without fio.
+
+    Return results shaped like those of run_fio.
+    """
+    with tempfile.NamedTemporaryFile(dir=target) as fp:
+        fd = open_direct(fp.name)
         try:
-            bw_bytes = perf["bw_bytes"]
-        except KeyError:
-            bw_bytes = perf["bw"] * 1024
+            # precondition
+            native_test(fd, False, 1 << 20, 8, 1, "write", size << 20, 1)
+
+            results = {}
+            for name, random, bs, iodepth, numjobs, rw in test_matrix():
+                perf = native_test(fd, random, bs << 10, iodepth, numjobs,
+                                   rw, size << 20, loops)
+                results[name, rw] = {"jobname": section_name(name, rw),
+                                     rw: perf}
+        finally:
+            os.close(fd)
+    return results
+
+
+def summarize(name, rw, perf):
+    """One result row from the read or write part of a fio job"""
+    try:
+        bw_bytes = perf["bw_bytes"]
+    except KeyError:
+        bw_bytes = perf["bw"] * 1024
+
+    # fio 3 reports clat_ns, older versions clat in usec
+    if "clat_ns" in perf:
+        pct, scale = perf["clat_ns"].get("percentile", {}), 1e-3
+    else:
+        pct, scale = perf.get("clat", {}).get("percentile", {}), 1
+
+    row = {"test": name, "rw": rw,
+           "mb_s": bw_bytes / (1 << 20), "iops": perf["iops"]}
+    for key, fio_key in PERCENTILES:
+        row[key] = pct.get(fio_key, 0) * scale
+    return row
+
+
+def disk_name(path):
+    """Name of the block device holding path, like nvme0n1p2"""
+    st = os.stat(path)
+    dev = "%d:%d" % (os.major(st.st_dev), os.minor(st.st_dev))
+    sys_path = "/sys/dev/block/" + dev
+    if os.path.exists(sys_path):
+        return os.path.basename(os.path.realpath(sys_path))
+    return dev
+
+
+def save(rows, path):
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as fout:
+            writer = csv.DictWriter(fout, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as fout:
+            json.dump(rows, fout, indent=2)
+
+
+def compare(rows, baseline, threshold):
+    """Print the change against baseline rows; return the regressions.
+
+    Throughput regresses when it drops, p99 latency when it grows, by more
+    than threshold.
+    """
+    old_rows = {(r["test"], r["rw"]): r for r in baseline}
+    regressions = []
+    for row in rows:
+        old = old_rows.get((row["test"], row["rw"]))
+        if old is None:
+            continue
+        for metric, higher_is_better in (("mb_s", True), ("p99_us", False)):
+            if not old[metric] or not row[metric]:
+                continue
+            change = row[metric] / old[metric] - 1
+            print("%-12s %-5s %-8s %10.2f -> %10.2f  %+6.1f%%"
+                  % (row["test"], row["rw"], metric, old[metric], row[metric],
+                     change * 100))
+            if (change < -threshold if higher_is_better
+                    else change > threshold):
+                regressions.append((row["test"], row["rw"], metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate CrystalDiskMark using fio")
+    parser.add_argument("-n", "--loops", type=int, default=5,
+                        help="Number of runs for each test.")
+    parser.add_argument("-s", "--size", type=int, default=1024,
+                        help="IO size (in MiB) for each test.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="Save results as CSV if FILE ends with .csv, "
+                             "else as JSON.")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="JSON file of results per disk to compare with.")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store this run as the baseline of the disk.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Allowed relative regression (default 0.1).")
+    parser.add_argument("--disk",
+                        help="Baseline key, by default the block device "
+                             "holding the test directory.")
+    parser.add_argument("--engine", choices=("auto", "fio", "python"),
+                        default="auto",
+                        help="Run tests with fio or in Python; auto uses fio "
+                             "if it is installed.")
+    parser.add_argument("target", help="Test directory.")
+    args = parser.parse_args()
+
+    if args.update_baseline and not args.baseline:
+        parser.error("--update-baseline requires --baseline")
+
+    engine = args.engine
+    if engine == "auto":
+        engine = "fio" if shutil.which("fio") else "python"
+        if engine == "python":
+            print("fio not found, using the Python engine", file=sys.stderr)
+
+    if engine == "fio":
+        results = run_fio(args.target, args.size, args.loops)
+    else:
+        results = run_native(args.target, args.size, args.loops)
+
+    rows = []
+    for name, random, _, _, _, rw in test_matrix():
+        row = summarize(name, rw, results[name, rw][rw])
+        rows.append(row)
+
+        print("%-12s %-5s : %10.2f MB/s" % (name, rw, row["mb_s"]), end="")
+        print("    [ %10.2f IOPS ]" % row["iops"] if random else "", end="")
+        print("    p50/p99/p99.9: %.0f/%.0f/%.0f us"
+              % tuple(row[k] for k, _ in PERCENTILES))
+
+    if args.output:
+        save(rows, args.output)
+
+    if args.baseline:
+        disk = args.disk or disk_name(args.target)
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as fin:
+                baselines = json.load(fin)
+
+        if args.update_baseline:
+            baselines[disk] = rows
+            with open(args.baseline, "w") as fout:
+                json.dump(baselines, fout, indent=2, sort_keys=True)
+        elif disk not in baselines:
+            print("No baseline for %s" % disk)
+        else:
+            regressions = compare(rows, baselines[disk], args.threshold)
+            if regressions:
+                print("Regressed: %s" % ", ".join(
+                    "%s %s %s" % r for r in regressions))
+                sys.exit(1)
 
-        bw_mib = bw_bytes / (1 << 20)
-        iops = perf["iops"]
 
-        print("%-12s %-5s : %10.2f MB/s" % (name, rw, bw_mib), end="")
-        print("    [ %10.2f IOPS ]" % iops if prefix else "")
+if __name__ == "__main__":
+    main()
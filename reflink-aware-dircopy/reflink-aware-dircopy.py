@@ -5,22 +5,52 @@ Copy directories while keeping reflinks.
 
 import argparse
 import array
+import bisect
+import errno
 import fcntl
+import json
 import logging
 import os
 import shutil
+import sqlite3
+import stat
 import struct
-import subprocess
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 STRUCT_FIEMAP = struct.Struct("=QQLLLL")
 STRUCT_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
 FIEMAP_FLAG_SYNC = 0x00000001
 FIEMAP_EXTENT_LAST = 0x00000001
 FIEMAP_EXTENT_SHARED = 0x00002000
+# UNKNOWN, DELALLOC, ENCODED, DATA_ENCRYPTED, NOT_ALIGNED, DATA_INLINE,
+# DATA_TAIL and UNWRITTEN: fe_physical doesn't hold the file data as is
+FIEMAP_EXTENT_UNCLONABLE = 0x00000F8E
 FS_IOC_FIEMAP = 0xC020660B
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940D
+STRUCT_FILE_CLONE_RANGE = struct.Struct("=qQQQ")
+COPY_BUFSIZE = 1 << 20
+COPY_CHUNK = 1 << 30
 
+# Data is copied by the first of these that works
+COPY_METHODS = ("copy_file_range", "sendfile", "read")
+COPY_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL)
+UNSUPPORTED_METHODS = set()
 
-def get_fiemap_extents(path):
+# errno of FICLONE when the filesystem has no reflinks at all, and when
+# only these two files can't share extents
+REFLINK_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY)
+REFLINK_REFUSED = (errno.EXDEV, errno.EINVAL)
+
+
+def read_fiemap(path):
+    """Return all extents of path as (logical, physical, length, flags).
+
+    None if the file changed while being mapped.
+    """
     with open(path) as fd:
         num_of_extents = 0
 
@@ -46,7 +76,7 @@ def get_fiemap_extents(path):
 
             if num_of_extents == 0:
                 # May happen if file is sparse
-                return None
+                return ()
 
     offset = STRUCT_FIEMAP.size
     extents = []
@@ -54,117 +84,965 @@ def get_fiemap_extents(path):
     for _ in range(num_of_extents):
         fe_logical, fe_physical, fe_length, _, _, fe_flags, _, _, _ = \
             STRUCT_FIEMAP_EXTENT.unpack_from(buffer[offset:offset + STRUCT_FIEMAP_EXTENT.size])
+        extents.append((fe_logical, fe_physical, fe_length, fe_flags))
+        offset += STRUCT_FIEMAP_EXTENT.size
+
+    if not(fe_flags & FIEMAP_EXTENT_LAST):
+        # If not, likely the file changed between two ioctl calls?
+        return None
+
+    return tuple(extents)
 
+
+def whole_file_key(extents):
+    """(logical, physical, length) of every extent if all are shared"""
+    if not extents:
+        return None
+    for _, _, _, fe_flags in extents:
         if not(fe_flags & FIEMAP_EXTENT_SHARED):
             # Ensure all extents are shared. May be too restrictive
             return None
+    return tuple(extent[:3] for extent in extents)
 
-        extents.append((fe_logical, fe_physical, fe_length))
-        offset += STRUCT_FIEMAP_EXTENT.size
 
-    if not(fe_flags & FIEMAP_EXTENT_LAST):
-        # If not, likely the file changed between two ioctl calls?
+def get_fiemap_extents(path):
+    extents = read_fiemap(path)
+    return whole_file_key(extents)
+
+
+def clonable_extents(extents, size):
+    """Shared extents whose blocks hold the file data, clipped to size"""
+    result = []
+    for fe_logical, fe_physical, fe_length, fe_flags in extents or ():
+        if fe_flags & FIEMAP_EXTENT_SHARED and not fe_flags & FIEMAP_EXTENT_UNCLONABLE:
+            fe_length = min(fe_length, size - fe_logical)
+            if fe_length > 0:
+                result.append((fe_logical, fe_physical, fe_length))
+    return result
+
+
+class ExtentIndex:
+    """Physical ranges of copied files, sorted by fe_physical.
+
+    Ranges never overlap, so sorted starts and a bisect are all the
+    interval tree needed.  They are kept in blocks of up to 2 * BLOCK
+    ranges with the start of each block in `firsts`, so adding a range
+    shifts one block instead of the whole index.  Each range remembers
+    the destination file and offset its data was copied to.
+    """
+
+    BLOCK = 512
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.blocks = []
+        self.firsts = []
+
+    def __find(self, pos):
+        """Position of the range holding pos, or of the first one after"""
+        b = max(0, bisect.bisect_right(self.firsts, pos) - 1)
+        if b == len(self.blocks):
+            return b, 0
+        block = self.blocks[b]
+        i = bisect.bisect_right(block, (pos, float("inf"))) - 1
+        if i < 0 or block[i][1] <= pos:
+            i += 1
+        if i == len(block):
+            return b + 1, 0
+        return b, i
+
+    def __get(self, b, i):
+        if b < len(self.blocks):
+            return self.blocks[b][i]
         return None
 
-    return tuple(extents)
+    def __next(self, b, i):
+        if i + 1 < len(self.blocks[b]):
+            return b, i + 1
+        return b + 1, 0
+
+    def __insert(self, item):
+        if not self.blocks:
+            self.blocks.append([item])
+            self.firsts.append(item[0])
+            return
+
+        b = max(0, bisect.bisect_right(self.firsts, item[0]) - 1)
+        block = self.blocks[b]
+        bisect.insort(block, item)
+        self.firsts[b] = block[0][0]
+        if len(block) > 2 * self.BLOCK:
+            self.blocks.insert(b + 1, block[self.BLOCK:])
+            self.firsts.insert(b + 1, block[self.BLOCK][0])
+            del block[self.BLOCK:]
+
+    def __delete(self, b, i):
+        """Remove a range, return the position of the one after it"""
+        block = self.blocks[b]
+        del block[i]
+        if not block:
+            del self.blocks[b]
+            del self.firsts[b]
+            return b, 0
+        self.firsts[b] = block[0][0]
+        if i == len(block):
+            return b + 1, 0
+        return b, i
+
+    def load(self, items):
+        """Fill the empty index with (physical, length, path, offset) of
+        any number of files at once.  Where they overlap, the part is
+        kept by one of them."""
+        ranges = []
+        pos = None
+        for physical, length, path, offset in sorted(items, key=lambda x: x[0]):
+            start, stop = physical, physical + length
+            if pos is not None and start < pos:
+                if stop <= pos:
+                    continue
+                offset += pos - start
+                start = pos
+            ranges.append((start, stop, path, offset))
+            pos = stop
+
+        self.blocks = [ranges[i:i + self.BLOCK]
+                       for i in range(0, len(ranges), self.BLOCK)]
+        self.firsts = [block[0][0] for block in self.blocks]
+
+    def claim(self, extents, dst):
+        """Look up extents (logical, physical, length) of the file copied
+        to dst and add the parts not found.
+
+        Return the parts found as (logical, length, path, offset): data
+        at logical in the file is at offset in the already copied path.
+        """
+        found = []
+        for logical, physical, length in extents:
+            new = []
+            pos = physical
+            end = physical + length
+            b, i = self.__find(pos)
+            while pos < end:
+                item = self.__get(b, i)
+                if item is not None and item[0] <= pos:
+                    start, stop, path, offset = item
+                    stop = min(stop, end)
+                    if path != dst:
+                        # Blocks repeated within dst itself just get copied
+                        found.append((logical + pos - physical, stop - pos,
+                                      path, offset + pos - start))
+                    pos = stop
+                    b, i = self.__next(b, i)
+                else:
+                    stop = end
+                    if item is not None:
+                        stop = min(stop, item[0])
+                    new.append((pos, stop, dst, logical + pos - physical))
+                    pos = stop
+
+            for item in new:
+                self.__insert(item)
+
+        return sorted(found)
+
+    def forget(self, dst, extents):
+        """Drop the ranges of dst within its extents"""
+        for _, physical, length in extents:
+            b, i = self.__find(physical)
+            while True:
+                item = self.__get(b, i)
+                if item is None or item[0] >= physical + length:
+                    break
+                if item[2] == dst:
+                    b, i = self.__delete(b, i)
+                else:
+                    b, i = self.__next(b, i)
+
 
+def reflink(src, dst):
+    """Make dst share all extents of src with the FICLONE ioctl"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst, FICLONE, fsrc.fileno())
 
-def copy_file_attributes(src, dst):
-    """Improved copystat to keep file owner as well"""
-    shutil.copystat(src, dst)
-    st = os.lstat(src)
+
+def reflink_range(fsrc, src_offset, fdst, dst_offset, length):
+    """Make [dst_offset, +length) of fdst share the extents of fsrc"""
+    arg = STRUCT_FILE_CLONE_RANGE.pack(fsrc.fileno(), src_offset, length, dst_offset)
+    fcntl.ioctl(fdst, FICLONERANGE, arg)
+
+
+def iter_data(fd, start, end):
+    """Yield (offset, length) of the data in [start, end), skipping holes"""
+    pos = start
+    while pos < end:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # No SEEK_DATA here, take it all as data
+            yield pos, end - pos
+            return
+        if data >= end:
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole - data
+        pos = hole
+
+
+def copy_bytes(src_fd, dst_fd, offset, length):
+    """Copy [offset, +length) between files, in the kernel if possible.
+
+    copy_file_range is tried first, then sendfile, then read and write.
+    A method failing as unsupported isn't tried again.
+    """
+    while length > 0:
+        chunk = min(length, COPY_CHUNK)
+        method = next(m for m in COPY_METHODS if m not in UNSUPPORTED_METHODS)
+        try:
+            if method == "copy_file_range":
+                n = os.copy_file_range(src_fd, dst_fd, chunk, offset, offset)
+            elif method == "sendfile":
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                n = os.sendfile(dst_fd, src_fd, offset, chunk)
+            else:
+                n = os.pwrite(dst_fd, os.pread(src_fd, min(chunk, COPY_BUFSIZE), offset), offset)
+        except OSError as e:
+            if method == "read" or e.errno not in COPY_UNSUPPORTED:
+                raise
+            logging.debug("%s failed (%s)", method, os.strerror(e.errno))
+            UNSUPPORTED_METHODS.add(method)
+            continue
+        if n == 0:
+            # The file got shorter
+            break
+        offset += n
+        length -= n
+
+
+def copy_range(fsrc, fdst, offset, length):
+    """Copy the data in [offset, +length) at the same offset, keeping holes"""
+    for pos, size in iter_data(fsrc.fileno(), offset, offset + length):
+        copy_bytes(fsrc.fileno(), fdst.fileno(), pos, size)
+
+
+def copy_sparse(src, dst):
+    """Copy the content of src to dst, holes and all"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copy_range(fsrc, fdst, 0, size)
+        fdst.truncate(size)
+
+
+def stat_identity(st):
+    """Changes whenever the file is written to or replaced"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class Journal:
+    """Files copied so far, kept in an SQLite database across runs.
+
+    Each row holds the source identity and extents at the time it was
+    copied, so a resumed run can tell finished files from changed ones
+    and rebuild its reflink tables without mapping everything again.
+    """
+
+    STRUCT_EXTENT = struct.Struct("=QQQL")
+
+    def __init__(self, path, commit_every=5.0):
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                src BLOB PRIMARY KEY,
+                dst BLOB NOT NULL,
+                dev INTEGER, ino INTEGER, size INTEGER,
+                mtime_ns INTEGER, ctime_ns INTEGER,
+                extents BLOB
+            )""")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.committed = time.monotonic()
+
+    def __iter__(self):
+        """Yield (src, dst, identity, extents) of every copied file"""
+        for src, dst, *identity, extents in self.db.execute(
+                "SELECT src, dst, dev, ino, size, mtime_ns, ctime_ns, extents FROM files"):
+            if extents is not None:
+                size = self.STRUCT_EXTENT.size
+                extents = tuple(self.STRUCT_EXTENT.unpack_from(extents, offset)
+                                for offset in range(0, len(extents), size))
+            yield os.fsdecode(src), os.fsdecode(dst), tuple(identity), extents
+
+    def add(self, src, dst, st, extents):
+        if extents is not None:
+            extents = b"".join(self.STRUCT_EXTENT.pack(*e) for e in extents)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)",
+                            (os.fsencode(src), os.fsencode(dst),
+                             *stat_identity(st), extents))
+            # Losing the last few seconds only means copying them again
+            if time.monotonic() - self.committed > self.commit_every:
+                self.db.commit()
+                self.committed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+# errno of xattr calls the filesystem or our privileges don't allow
+XATTR_IGNORED = (errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL)
+
+
+def copy_xattrs(src, dst, follow_symlinks=True):
+    """Copy extended attributes, POSIX ACLs (system.posix_acl_*) included"""
+    try:
+        names = os.listxattr(src, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno not in XATTR_IGNORED:
+            raise
+        return
+
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=follow_symlinks)
+            os.setxattr(dst, name, value, follow_symlinks=follow_symlinks)
+        except OSError as e:
+            if e.errno not in XATTR_IGNORED:
+                raise
+
+
+def copy_file_attributes(src, dst, st=None):
+    """Improved copystat to keep file owner as well
+
+    st is the lstat of src if already known.  Symlinks are not followed.
+    """
+    if st is None:
+        st = os.lstat(src)
+    follow = not stat.S_ISLNK(st.st_mode)
+
+    # chown clears setuid bits and file capabilities, so it goes first
     os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if follow:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    copy_xattrs(src, dst, follow)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def is_copied(src_stat, dst):
+    """Whether dst looks like a finished copy, as far as stat tells"""
+    try:
+        dst_stat = os.lstat(dst)
+    except OSError:
+        # Missing, or a parent of it is not a directory
+        return False
+
+    for attr in "st_mode", "st_uid", "st_gid", "st_size", "st_mtime":
+        if getattr(src_stat, attr) != getattr(dst_stat, attr):
+            return False
+    return True
+
+
+class PendingDir:
+    """A directory whose metadata is applied once `left` drops to zero.
+
+    left counts its entries not copied yet, plus one while it is listed.
+    """
+
+    __slots__ = "src", "dst", "st", "parent", "left"
+
+    def __init__(self, src, dst, st, parent):
+        self.src = src
+        self.dst = dst
+        self.st = st
+        self.parent = parent
+        self.left = 1
 
 
 class CopyHelper:
-    def __init__(self):
+    """Copy trees, reflinking data that was already copied.
+
+    Files whose extents are all shared with an earlier file are cloned
+    whole from it (file_mapping).  Otherwise the shared extents found in
+    extent_index are cloned from wherever they were copied to, and only
+    the rest of the file is copied.
+
+    Files with more than one link are copied once and linked again with
+    os.link at their other paths, through inode_mapping from (st_dev,
+    st_ino) to the first destination.
+
+    With workers > 1 files are copied concurrently.  Every file being
+    copied is in `pending` until its data is in place, and files
+    reflinking or linking from it wait for that.
+
+    With a Journal, files copied by an earlier run are skipped if their
+    source is unchanged, and the tables are filled from it.  Those entries
+    are `unverified` until first used: the source is mapped again then,
+    and the entry dropped if it moved or changed.
+    """
+
+    def __init__(self, workers=1, journal=None):
+        self.workers = workers
         self.file_mapping = dict()
+        self.extent_index = ExtentIndex()
+        self.inode_mapping = dict()
+        self.pending = dict()
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.can_reflink = True
+
+        self.journal = journal
+        self.done = dict()
+        self.unverified = dict()
+        if journal is not None:
+            self.__load_journal()
+
+    def __load_journal(self):
+        ranges = []
+        for src, dst, identity, extents in self.journal:
+            self.done[src] = dst, identity
+            self.inode_mapping.setdefault(identity[:2], dst)
+            self.unverified[dst] = src, identity, extents
 
-    def __copy_symlink(self, src, dst):
-        if os.path.exists(dst):
+            key = whole_file_key(extents)
+            if key is not None:
+                self.file_mapping.setdefault(key, dst)
+            for logical, physical, length in clonable_extents(extents, identity[2]):
+                ranges.append((physical, length, dst, logical))
+
+        # Sorted once rather than claimed one by one
+        self.extent_index.load(ranges)
+
+        logging.info("JOURNAL: %d files done", len(self.done))
+
+    def __verified(self, dst):
+        """Check an entry loaded from the journal on first use, with the
+        lock held.  Return False if it was dropped."""
+        if dst not in self.unverified:
+            return True
+
+        src, identity, extents = entry = self.unverified.pop(dst)
+        try:
+            src_stat = os.lstat(src)
+            dst_stat = os.lstat(dst)
+            ok = (stat_identity(src_stat) == identity
+                  and (dst_stat.st_size, dst_stat.st_mtime_ns) == identity[2:4]
+                  and read_fiemap(src) == extents)
+        except OSError:
+            ok = False
+
+        if not ok:
+            logging.info("STALE: %r", dst)
+            self.__forget(dst, entry)
+        return ok
+
+    def __forget(self, dst, entry):
+        """Drop what the journal entry of dst put in the tables"""
+        _, identity, extents = entry
+        key = whole_file_key(extents)
+        if self.file_mapping.get(key) == dst:
+            del self.file_mapping[key]
+        if self.inode_mapping.get(identity[:2]) == dst:
+            del self.inode_mapping[identity[:2]]
+        self.extent_index.forget(dst, clonable_extents(extents, identity[2]))
+
+    def __copy_symlink(self, src, dst, src_stat):
+        if os.path.lexists(dst):
             os.unlink(dst)
 
         linkto = os.readlink(src)
         logging.info("COPY LINK: %r (%r) -> %r", src, linkto, dst)
 
         os.symlink(linkto, dst)
-        copy_file_attributes(src, dst)
-
-    def __copy_regular_file(self, src, dst):
-        extents = get_fiemap_extents(src)
-        reflink_from = self.file_mapping.get(extents)
+        copy_file_attributes(src, dst, src_stat)
 
-        if os.path.exists(dst):
-            src_stat = os.lstat(src)
-            dst_stat = os.lstat(dst)
+    def __copy_regular_file(self, src, dst, src_stat):
+        if self.done.get(src) == (dst, stat_identity(src_stat)):
+            logging.info("DONE: %r", dst)
+            return
 
-            for attr in "st_mode", "st_uid", "st_gid", "st_size", "st_mtime":
-                if getattr(src_stat, attr) != getattr(dst_stat, attr):
-                    break
+        with self.lock:
+            link_from = dst
+            if src_stat.st_nlink > 1:
+                inode = (src_stat.st_dev, src_stat.st_ino)
+                link_from = self.inode_mapping.get(inode)
+                if link_from is None or not self.__verified(link_from):
+                    link_from = self.inode_mapping[inode] = dst
+            if link_from == dst:
+                done = self.pending[dst] = threading.Event()
             else:
-                logging.info("SKIP: %r", dst)
+                waiting = self.pending.get(link_from)
+
+        if link_from != dst:
+            if self.__copy_hardlink(link_from, dst, waiting):
+                if self.journal is not None:
+                    self.journal.add(src, dst, src_stat, None)
                 return
+            with self.lock:
+                done = self.pending[dst] = threading.Event()
 
-        if reflink_from is None and extents is not None:
-            self.file_mapping[extents] = dst
+        try:
+            extents = self.__copy_file(src, src_stat, dst)
+            if self.journal is not None:
+                self.journal.add(src, dst, src_stat, extents)
+        except BaseException:
+            with self.lock:
+                self.failed.add(dst)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[dst]
+            done.set()
 
+    def __copy_hardlink(self, link_from, dst, waiting):
+        """Link dst to link_from, return False if it must be copied instead"""
+        if waiting is not None:
+            waiting.wait()
+        with self.lock:
+            failed = link_from in self.failed
+
+        if os.path.lexists(dst):
+            if not failed and os.path.samestat(os.lstat(dst), os.lstat(link_from)):
+                logging.info("SKIP: %r", dst)
+                return True
+            os.unlink(dst)
+
+        if not failed:
+            logging.info("LINK: %r -> %r", link_from, dst)
+            try:
+                os.link(link_from, dst)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EMLINK, errno.EXDEV):
+                    raise
+                logging.warning("LINK FAILED (%s), falling back to copy",
+                                os.strerror(e.errno))
+        return False
+
+    def __copy_file(self, src, src_stat, dst):
+        extents = read_fiemap(src)
+        key = whole_file_key(extents)
+
+        if is_copied(src_stat, dst):
+            logging.info("SKIP: %r", dst)
+            return extents
+
+        registered = False
+        with self.lock:
+            entry = self.unverified.pop(dst, None)
+            if entry is not None:
+                # Copied by an earlier run, but about to be overwritten
+                self.__forget(dst, entry)
+
+            reflink_from = self.file_mapping.get(key)
+            if reflink_from is not None and not self.__verified(reflink_from):
+                reflink_from = None
+            ranges = []
+            if reflink_from is None and self.can_reflink:
+                if key is not None:
+                    self.file_mapping[key] = dst
+                shared = clonable_extents(extents, src_stat.st_size)
+                while True:
+                    ranges = self.extent_index.claim(shared, dst)
+                    # Claim again what stale entries covered
+                    if all([self.__verified(r[2]) for r in ranges]):
+                        break
+                registered = True
+
+            sources = {reflink_from} if reflink_from else {r[2] for r in ranges}
+            waiting = [self.pending[p] for p in sources if p in self.pending]
+
+        try:
+            self.__copy_data(src, dst, src_stat, reflink_from, ranges, waiting)
+        except BaseException:
+            if registered:
+                # Let the others copy for themselves
+                with self.lock:
+                    if self.file_mapping.get(key) == dst:
+                        del self.file_mapping[key]
+                    self.extent_index.forget(dst, shared)
+            raise
+        return extents
+
+    def __disable_reflink(self):
+        # Don't bother with the rest of the tree
+        with self.lock:
+            self.can_reflink = False
+            self.file_mapping.clear()
+            self.extent_index.clear()
+
+    def __copy_data(self, src, dst, src_stat, reflink_from, ranges, waiting):
         logging.info("COPY: %r -> %r", src, dst)
 
-        if reflink_from is None:
-            shutil.copy(src, dst)
-            copy_file_attributes(src, dst)
-        else:
+        if waiting:
+            for event in waiting:
+                event.wait()
+            with self.lock:
+                if reflink_from in self.failed:
+                    reflink_from = None
+                ranges = [r for r in ranges if r[2] not in self.failed]
+
+        if reflink_from is not None:
             logging.info("REFLINK: %r -> %r", reflink_from, dst)
-            cmd = ["/bin/cp", "--reflink=always", reflink_from, dst]
-            subprocess.check_call(cmd)
-            copy_file_attributes(src, dst)
+            try:
+                reflink(reflink_from, dst)
+            except OSError as e:
+                if e.errno not in REFLINK_UNSUPPORTED + REFLINK_REFUSED:
+                    raise
+                logging.warning("REFLINK FAILED (%s), falling back to copy",
+                                os.strerror(e.errno))
+                if e.errno in REFLINK_UNSUPPORTED:
+                    self.__disable_reflink()
+                reflink_from = None
+
+        if reflink_from is None:
+            if ranges:
+                self.__copy_with_ranges(src, dst, ranges)
+            else:
+                copy_sparse(src, dst)
+        copy_file_attributes(src, dst, src_stat)
+
+    def __copy_with_ranges(self, src, dst, ranges):
+        """Clone ranges (logical, length, path, offset) from the files they
+        were copied to and copy the rest of src."""
+        merged = []
+        for logical, length, path, offset in ranges:
+            if merged:
+                last_logical, last_length, last_path, last_offset = merged[-1]
+                if (last_path == path and last_logical + last_length == logical
+                        and last_offset + last_length == offset):
+                    merged[-1] = (last_logical, last_length + length, path, last_offset)
+                    continue
+            merged.append((logical, length, path, offset))
+
+        cloned = 0
+        pos = 0
+        refs = {}
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                block = os.fstat(fdst.fileno()).st_blksize
+                for logical, length, path, offset in merged:
+                    copy_range(fsrc, fdst, pos, logical - pos)
+                    done = self.__clone_range(refs, path, offset, fdst, logical, length, block)
+                    copy_range(fsrc, fdst, logical + done, length - done)
+                    cloned += done
+                    pos = logical + length
+                copy_range(fsrc, fdst, pos, size - pos)
+                fdst.truncate(size)
+        finally:
+            for fref in refs.values():
+                fref.close()
+
+        logging.info("REFLINK %d of %d bytes: %r", cloned, size, dst)
+
+    def __clone_range(self, refs, path, offset, fdst, logical, length, block):
+        """Clone as much of the range as possible and return its length"""
+        if not self.can_reflink:
+            return 0
+        if path not in refs:
+            refs[path] = open(path, "rb")
+
+        # An unaligned end is only allowed at EOF, retry without it
+        for size in length, length - length % block:
+            if size == 0:
+                break
+            try:
+                reflink_range(refs[path], offset, fdst, logical, size)
+                return size
+            except OSError as e:
+                if e.errno in REFLINK_UNSUPPORTED:
+                    self.__disable_reflink()
+                    break
+                if e.errno not in REFLINK_REFUSED:
+                    raise
+                if size == length - length % block:
+                    break
+
+        logging.warning("REFLINK FAILED for %d bytes at %d: %r", length, logical, fdst.name)
+        return 0
 
     def copy(self, src_dir, dst_dir):
-        def do_copy(src, dst):
-            if os.path.islink(src):
-                self.__copy_symlink(src, dst)
-            elif os.path.isfile(src):
-                self.__copy_regular_file(src, dst)
+        """Copy src_dir into dst_dir in one pass over the source tree.
+
+        Files are handed to the pool as directories are listed; the
+        metadata of a directory is applied as soon as everything in it
+        is copied, so its mtime sticks.
+        """
+        # Absolute paths are what the journal and the tables go by
+        src_dir = os.path.abspath(src_dir)
+        dst_dir = os.path.abspath(dst_dir)
+
+        errors = []
+        futures = {}
+
+        def copy_one(src, dst, st):
+            if stat.S_ISLNK(st.st_mode):
+                self.__copy_symlink(src, dst, st)
+            elif stat.S_ISREG(st.st_mode):
+                self.__copy_regular_file(src, dst, st)
             else:
                 logging.warning("Unknown file type: %r", src)
 
-        def copy_dir_metadata(src, dst):
-            """Copy fs attributes of directories because copytree doesn't do this."""
-            logging.info("COPY METADATA: %r -> %r", src, dst)
-            copy_file_attributes(src, dst)
+        def finish(pending_dir):
+            # Called once per entry copied, from any thread
+            while pending_dir is not None:
+                with self.lock:
+                    pending_dir.left -= 1
+                    if pending_dir.left:
+                        return
+
+                logging.info("COPY METADATA: %r -> %r", pending_dir.src, pending_dir.dst)
+                try:
+                    copy_file_attributes(pending_dir.src, pending_dir.dst, pending_dir.st)
+                except OSError as e:
+                    errors.append((pending_dir.src, pending_dir.dst, str(e)))
+                pending_dir = pending_dir.parent
+
+        def collect(done):
+            for future in done:
+                src, dst = futures.pop(future)
+                if future.exception() is not None:
+                    errors.append((src, dst, str(future.exception())))
 
-            for entry in os.scandir(src):
-                if entry.is_dir():
-                    next_src = os.path.join(src, entry.name)
-                    next_dst = os.path.join(dst, entry.name)
-                    copy_dir_metadata(next_src, next_dst)
+        def submit(src, dst, st, parent):
+            # Bounded backlog, so listing doesn't run far ahead of copying
+            while len(futures) >= 4 * self.workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(copy_one, src, dst, st)
+            futures[future] = src, dst
+            future.add_done_callback(lambda _: finish(parent))
 
-        shutil.copytree(
-            src_dir, dst_dir,
-            copy_function=do_copy,
-            dirs_exist_ok=True,
-            symlinks=False  # handle symlinks ourselves
-        )
+        def list_dir(pending_dir, stack):
+            os.makedirs(pending_dir.dst, exist_ok=True)
+            with os.scandir(pending_dir.src) as it:
+                entries = list(it)
 
-        copy_dir_metadata(src_dir, dst_dir)
+            for entry in entries:
+                dst = os.path.join(pending_dir.dst, entry.name)
+                try:
+                    # The lstat is cached in entry and used for all the
+                    # metadata; d_type tells directories apart
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    errors.append((entry.path, dst, str(e)))
+                    continue
+                with self.lock:
+                    pending_dir.left += 1
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(PendingDir(entry.path, dst, st, pending_dir))
+                else:
+                    submit(entry.path, dst, st, pending_dir)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            stack = [PendingDir(src_dir, dst_dir, os.lstat(src_dir), None)]
+            while stack:
+                pending_dir = stack.pop()
+                try:
+                    list_dir(pending_dir, stack)
+                except OSError as e:
+                    errors.append((pending_dir.src, pending_dir.dst, str(e)))
+                finish(pending_dir)
+            collect(wait(futures).done)
+
+        if errors:
+            raise shutil.Error(errors)
+
+
+def iter_tree(src_dir, dst_dir):
+    """Yield (src, dst, lstat) of everything but directories below src_dir.
+
+    lstat is None for entries that cannot be stat'ed and for directories
+    that cannot be listed.
+    """
+    stack = [(src_dir, dst_dir)]
+    while stack:
+        src, dst = stack.pop()
+        try:
+            with os.scandir(src) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.warning("Cannot list %r: %s", src, e)
+            yield src, dst, None
+            continue
+
+        for entry in entries:
+            next_dst = os.path.join(dst, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, next_dst))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                logging.warning("Cannot stat %r: %s", entry.path, e)
+                st = None
+            yield entry.path, next_dst, st
+
+
+def scan_extents(files, workers):
+    """Yield (src, dst, lstat, extents) with FIEMAP run by `workers` threads,
+    in the order of files."""
+    def fiemap(item):
+        src, _, st = item
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        try:
+            return read_fiemap(src)
+        except OSError:
+            return None
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in files:
+            pending.append((item, executor.submit(fiemap, item)))
+            if len(pending) >= 4 * workers:
+                item, future = pending.popleft()
+                yield item + (future.result(),)
+        while pending:
+            item, future = pending.popleft()
+            yield item + (future.result(),)
+
+
+def data_size(st, extents):
+    """Bytes of data in a file, holes left out"""
+    if not extents:
+        return min(st.st_size, st.st_blocks * 512)
+    return sum(max(0, min(length, st.st_size - logical))
+               for logical, _, length, _ in extents)
+
+
+def plan_copy(pairs, workers=1, journal=None, rate=200, top=10):
+    """Work out what copying each (src_dir, dst_dir) would do, without
+    writing anything, and return it as a dict for JSON.
+
+    Files are taken in the same way CopyHelper does: hardlinks first, then
+    whole-file reflinks, then partial ones.  copy_seconds assumes copied
+    data moves at `rate` MB/s.  Entries that cannot be listed or stat'ed
+    are counted as "error".
+    """
+    done = {}
+    if journal is not None:
+        done = {src: (dst, identity) for src, dst, identity, _ in journal}
+
+    files = Counter()
+    data = Counter()
+    inodes = set()
+    groups = {}
+    index = ExtentIndex()
+    refs = Counter()
+
+    def tree():
+        for src_dir, dst_dir in pairs:
+            yield from iter_tree(os.path.abspath(src_dir), os.path.abspath(dst_dir))
+
+    for src, dst, st, extents in scan_extents(tree(), workers):
+        if st is None:
+            files["error"] += 1
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            files["symlink"] += 1
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            files["unknown"] += 1
+            continue
+
+        size = data_size(st, extents)
+        inode = (st.st_dev, st.st_ino)
+        key = whole_file_key(extents)
+        if done.get(src) == (dst, stat_identity(st)):
+            action = "done"
+        elif st.st_nlink > 1 and inode in inodes:
+            action = "hardlink"
+        elif is_copied(st, dst):
+            action = "skip"
+        elif key in groups:
+            action = "reflink"
+            groups[key][1].append(src)
+        else:
+            if key is not None:
+                groups[key] = (size, [src])
+            ranges = index.claim(clonable_extents(extents, st.st_size), dst)
+            cloned = min(size, sum(length for _, length, _, _ in ranges))
+            action = "partial_reflink" if cloned else "copy"
+            data["reflink"] += cloned
+            size -= cloned
+
+        if action not in ("done", "hardlink"):
+            inodes.add(inode)
+            for _, fe_physical, fe_length, fe_flags in extents or ():
+                if fe_flags & FIEMAP_EXTENT_SHARED:
+                    refs[fe_physical, fe_length] += 1
+
+        files[action] += 1
+        data["copy" if action == "partial_reflink" else action] += size
+
+    histogram = Counter()
+    for (_, length), count in refs.items():
+        histogram[count] += length
+
+    largest = sorted(((len(paths) - 1) * size, paths)
+                     for size, paths in groups.values() if len(paths) > 1)[-top:]
+
+    return {
+        "files": dict(files),
+        "bytes": dict(data),
+        "copy_seconds": data["copy"] / (rate * 1e6),
+        # Bytes of shared extents by the number of files here using them;
+        # 1 means shared with files outside the tree
+        "sharing_histogram": {str(k): histogram[k] for k in sorted(histogram)},
+        "largest_groups": [{"bytes_saved": saved, "files": len(paths), "paths": paths[:5]}
+                           for saved, paths in reversed(largest)],
+    }
 
 
 def main():
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Reflink-aware directory copy script")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of files copied concurrently")
+    parser.add_argument('--journal', metavar="PATH",
+                        help="Record finished files at PATH and skip them "
+                             "when run again")
+    parser.add_argument('--plan', action='store_true',
+                        help="Only print a JSON report of what would be "
+                             "reflinked, linked and copied")
+    parser.add_argument('--rate', type=float, default=200,
+                        help="Copy speed in MB/s assumed by --plan")
     parser.add_argument('source_dirs', metavar="SOURCE", nargs='+')
     parser.add_argument('dest_dir', metavar="DEST")
     args = parser.parse_args()
 
-    helper = CopyHelper()
-
     if len(args.source_dirs) == 1:
-        helper.copy(args.source_dirs[0], args.dest_dir)
+        pairs = [(args.source_dirs[0], args.dest_dir)]
     else:
-        for d in args.source_dirs:
-            name = os.path.basename(os.path.realpath(d))
-            helper.copy(d, os.path.join(args.dest_dir, name))
+        pairs = [(d, os.path.join(args.dest_dir, os.path.basename(os.path.realpath(d))))
+                 for d in args.source_dirs]
+
+    journal = None
+    if args.journal and (not args.plan or os.path.exists(args.journal)):
+        journal = Journal(args.journal)
+
+    try:
+        if args.plan:
+            report = plan_copy(pairs, args.jobs, journal, args.rate)
+            print(json.dumps(report, indent=2))
+            return
+
+        helper = CopyHelper(workers=args.jobs, journal=journal)
+        for src_dir, dst_dir in pairs:
+            helper.copy(src_dir, dst_dir)
+    finally:
+        if journal is not None:
+            journal.close()
 
 
 if __name__ == "__main__":